@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Compares Censor against running ProfanityFilter.censor directly on a
+# synthetic multireddit's worth of records, checks the output is identical
+# and reports the speedup.
+#
+#   python3 benchmarks/censor_benchmark.py [records]
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from code.config import getConfig
+from code.censor import Censor
+from profanityfilter import ProfanityFilter
+
+import random
+import logging
+import time
+
+
+def _reference_filters(cp):
+    # one ProfanityFilter per category, set up the way Censor sets up its own
+    filters = {}
+    for cat in ('title', 'user', 'subreddit'):
+        section = f'{cat}-language-filter'
+        if not cp.getboolean(section, 'filter'):
+            continue
+        pf = ProfanityFilter(no_word_boundaries=not cp.getboolean(section, 'wholeword'))
+        for word in [item for item in pf._censor_list if len(item) <= 2]:
+            pf.remove_word(word)
+        censor_char = cp[section]['character']
+        pf.set_censor('' if censor_char == 'erase' else censor_char)
+        filters[cat] = pf
+    return filters
+
+
+def _records(count, rng):
+    bad = ProfanityFilter()._censor_list
+    clean = ['sunset', 'over', 'the', 'lake', 'Yosemite', 'valley', 'at', 'dawn',
+             'my', 'first', 'attempt', 'old', 'barn', 'in', 'Iowa', '[OC]', '[4032x3024]']
+    subreddits = ['EarthPorn', 'CityPorn', 'SkyPorn', 'BotanicalPorn', 'WaterPorn', 'AbandonedPorn']
+    records = []
+    for i in range(count):
+        words = [rng.choice(clean) for _ in range(rng.randint(4, 14))]
+        if rng.random() < 0.1:
+            words.insert(rng.randrange(len(words)), rng.choice(bad))
+        user = f'{rng.choice(clean)}_{rng.choice(clean + bad[:20])}{i % 50}'
+        records.append({'title': ' '.join(words), 'user': user, 'subreddit': rng.choice(subreddits)})
+    return records
+
+
+def main(count):
+    cp = getConfig()
+    log = logging.getLogger('censor_benchmark')
+    records = _records(count, random.Random(0))
+
+    start = time.perf_counter()
+    filters = _reference_filters(cp)
+    expected = []
+    for record in records:
+        expected.append({k: filters[k].censor(v) if k in filters else v for k, v in record.items()})
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cen = Censor(cp)
+    actual = []
+    for record in records:
+        record = dict(record)
+        cen.censor_record(record, log)
+        actual.append(record)
+    compiled_time = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(actual, expected) if a != b)
+    print(f'{count} records')
+    print(f'ProfanityFilter.censor: {reference_time:.3f} s')
+    print(f'Censor:                 {compiled_time:.3f} s (including setup)')
+    print(f'speedup:                {reference_time / compiled_time:.1f}x')
+    print(f'mismatches:             {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 250))
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# Runs the whole pipeline (listing, filtering, database, download, render)
+# against a local stand-in for reddit, i.redd.it, imgur and flickr, and
+# reports throughput, peak memory and time per stage.
+#
+#   python3 benchmarks/offline_benchmark.py --font /path/to/font.ttf
+#
+# The stand-in is an HTTP proxy on localhost; every request the pipeline
+# makes goes through it, so nothing reaches the real sites.
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import reddit_image_download
+from code.config import getDefaultConfig
+from code import session
+from code import metrics
+
+from PIL import Image
+from PIL import ImageDraw
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from requests.adapters import BaseAdapter
+import argparse
+import requests
+import resource
+import tempfile
+import threading
+import logging
+import random
+import json
+import time
+import io
+
+_subreddits = ['EarthPorn', 'CityPorn', 'SkyPorn', 'WaterPorn', 'AbandonedPorn']
+_words = ['sunset', 'over', 'the', 'lake', 'valley', 'at', 'dawn', 'old', 'barn',
+          'in', 'Iowa', 'misty', 'morning', 'Yosemite', '[OC]', '[4032x3024]']
+
+
+class Corpus:
+    def __init__(self, posts, width, height, seed=0):
+        rng = random.Random(seed)
+        self.listing = []
+        self.content = {}
+
+        base = self._base_image(width, height, rng)
+        for i in range(posts):
+            postcode = f'b{i:05d}'
+            # unique bytes after the JPEG end marker keep every post distinct
+            # for the content hash without encoding a new image each time
+            body = base + postcode.encode('ascii')
+            kind = i % 4
+            if kind == 0:
+                url = f'http://i.redd.it/{postcode}.jpg'
+                self._add(url, 'image/jpeg', body)
+            elif kind == 1:
+                url = f'http://imgur.com/{postcode}'
+                page = f'<html><meta content="//i.imgur.com/{postcode}.jpg"></html>'
+                self._add(url, 'text/html', page.encode('utf-8'))
+                self._add(f'http://i.imgur.com/{postcode}.jpg', 'image/jpeg', body)
+            elif kind == 2:
+                url = f'http://www.flickr.com/photos/bench/{postcode}'
+                image_url = f'//live.staticflickr.com/65535/{postcode}_0a1b2c_d.jpg'
+                page = f'<html><a href="{image_url}">Download</a></html>'
+                self._add(url + '/sizes/k', 'text/html', page.encode('utf-8'))
+                self._add('http:' + image_url, 'image/jpeg', body)
+            else:
+                url = f'http://i.imgur.com/{postcode}.jpg'
+                self._add(url, 'image/jpeg', body)
+            title = ' '.join(rng.choice(_words) for _ in range(rng.randint(4, 20)))
+            self.listing.append(self._post(postcode, url, title, rng))
+
+        # a few posts that the filters should drop before any download
+        self.listing.append(self._post('g00000', 'http://i.redd.it/g00000.gif', 'gif', rng))
+        self.listing.append(self._post('v00000', 'http://v.redd.it/v00000', 'video', rng))
+        self.listing.append(self._post('s00000', 'http://www.reddit.com/r/x/comments/s00000/', 'self', rng,
+                                       selftext_html='<p>text</p>'))
+
+    def _base_image(self, width, height, rng):
+        im = Image.new('RGB', (width, height))
+        draw = ImageDraw.Draw(im)
+        for _ in range(200):
+            x, y = rng.randrange(width), rng.randrange(height)
+            color = tuple(rng.randrange(256) for _ in range(3))
+            draw.ellipse((x, y, x + width // 8, y + height // 8), fill=color)
+        bio = io.BytesIO()
+        im.save(bio, 'JPEG', quality=92)
+        return bio.getvalue()
+
+    def _post(self, postcode, url, title, rng, selftext_html=None):
+        return {'id': postcode, 'url': url, 'title': title,
+                'author': f'user{rng.randrange(1000)}', 'subreddit': rng.choice(_subreddits),
+                'over_18': False, 'selftext_html': selftext_html}
+
+    def _add(self, url, content_type, body):
+        parts = urlsplit(url)
+        self.content[(parts.hostname, parts.path)] = (content_type, body)
+
+    def listing_page(self, limit, after):
+        start = 0
+        if after is not None:
+            start = next(i for i, post in enumerate(self.listing) if f't3_{post["id"]}' == after) + 1
+        posts = self.listing[start:start + limit]
+        last = start + len(posts)
+        return {'kind': 'Listing',
+                'data': {'children': [{'kind': 't3', 'data': post} for post in posts],
+                         'after': f't3_{posts[-1]["id"]}' if posts and last < len(self.listing) else None}}
+
+
+def _handler(corpus):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            if parts.hostname == 'www.reddit.com':
+                query = parse_qs(parts.query)
+                page = corpus.listing_page(int(query['limit'][0]), query.get('after', [None])[0])
+                self._send(200, 'application/json', json.dumps(page).encode('utf-8'))
+                return
+            item = corpus.content.get((parts.hostname, parts.path))
+            if item is None:
+                self._send(404, 'text/plain', b'not found')
+            else:
+                self._send(200, *item)
+
+        def _send(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class _PlainHTTP(BaseAdapter):
+    # the stand-in only speaks plain http, but the resolvers always give
+    # https image urls, so those are sent as http through the same pool
+    def __init__(self, adapter):
+        super().__init__()
+        self._adapter = adapter
+
+    def send(self, request, **kwargs):
+        request.url = 'http://' + request.url[len('https://'):]
+        return self._adapter.send(request, **kwargs)
+
+    def close(self):
+        self._adapter.close()
+
+
+def _configure_offline(configure):
+    def configure_offline(cp):
+        configure(cp)
+        session._session.mount('https://', _PlainHTTP(session._session.get_adapter('http://')))
+    return configure_offline
+
+
+class OfflineReddit:
+    # stands in for praw.Reddit; only request() is used by get_submissions
+    def __init__(self, proxy):
+        self._proxies = {'http': proxy}
+
+    def request(self, method, path, params=None, data=None, files=None):
+        response = requests.request(method, f'http://www.reddit.com/{path}', params=params,
+                                    proxies=self._proxies, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+
+def _config(args, workdir):
+    cp = getDefaultConfig()
+    cp['multireddit']['user'] = 'bench'
+    cp['multireddit']['multi'] = 'bench'
+    cp['limits']['posts'] = str(args.posts + 3)
+    cp['limits']['images'] = str(args.images)
+    cp['paths']['images'] = os.path.join(workdir, 'images')
+    cp['paths']['cache'] = os.path.join(workdir, 'cache')
+    cp['rate-limit']['seconds'] = str(args.rate_limit)
+    if args.font is not None:
+        cp['title-font']['name'] = args.font
+        cp['timestamp-font']['name'] = args.font
+    if args.download_workers is not None:
+        cp['download']['workers'] = str(args.download_workers)
+    if args.render_workers is not None:
+        cp['render']['workers'] = str(args.render_workers)
+    return cp
+
+
+def _peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='offline throughput benchmark')
+    parser.add_argument('--posts', type=int, default=150)
+    parser.add_argument('--images', type=int, default=120)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--font', help='TrueType font for captions (default: the configured fonts)')
+    parser.add_argument('--rate-limit', type=float, default=0.0)
+    parser.add_argument('--download-workers', type=int)
+    parser.add_argument('--render-workers', type=int)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    corpus = Corpus(args.posts, args.width, args.height)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _handler(corpus))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    proxy = f'http://127.0.0.1:{server.server_port}'
+    os.environ['HTTP_PROXY'] = proxy
+    os.environ.pop('NO_PROXY', None)
+    os.environ.pop('no_proxy', None)
+    session.configure = _configure_offline(session.configure)
+
+    reddit_image_download.log.setLevel(logging.WARNING)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='reddit_image_download.bench.') as workdir:
+        cp = _config(args, workdir)
+        metrics.reset()
+        start = time.perf_counter()
+        try:
+            reddit_image_download.run(cp, OfflineReddit(proxy))
+        finally:
+            os.chdir(cwd)
+        elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    snapshot = metrics.snapshot()
+    images = snapshot['counters'].get('images-written', 0)
+    downloaded = snapshot['counters'].get('bytes-downloaded', 0)
+    report = {'seconds': elapsed,
+              'images': images,
+              'images_per_second': images / elapsed,
+              'bytes': downloaded,
+              'bytes_per_second': downloaded / elapsed,
+              'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF),
+              'peak_child_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+              'metrics': snapshot}
+
+    print(f"{images} images in {elapsed:.2f} s: {report['images_per_second']:.2f} images/s, "
+          f"{report['bytes_per_second'] / 1e6:.1f} MB/s")
+    print(f"peak RSS {report['peak_rss_mb']:.0f} MB (render processes {report['peak_child_rss_mb']:.0f} MB)")
+    for name, timing in sorted(snapshot['stages'].items(), key=lambda item: -item[1]['sum']):
+        print(f"  {name:<28} {timing['sum']:8.3f} s  {timing['count']:5d} x {timing['mean'] * 1000:8.1f} ms")
+    for name, value in snapshot['counters'].items():
+        print(f'  {name:<40} {value}')
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Measures how long reddit_image_download.py takes from process start to its
+# first network request, which is all the fixed cost a cron run pays before
+# it can find out whether there is anything to do.
+#
+#   python3 benchmarks/startup_benchmark.py --runs 10
+#
+# The script runs with a throwaway home directory and an HTTP(S) proxy on
+# localhost that notes the time of the first request and refuses it, so the
+# run ends there and nothing reaches reddit.
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import subprocess
+import statistics
+import threading
+import argparse
+import tempfile
+import json
+import time
+import sys
+import os
+
+_script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'reddit_image_download.py')
+
+
+def _handler(arrivals):
+    class Handler(BaseHTTPRequestHandler):
+        def _refuse(self):
+            # CLOCK_MONOTONIC is the same clock in every process
+            arrivals.append(time.monotonic())
+            self.send_error(502)
+
+        do_CONNECT = _refuse
+        do_GET = _refuse
+        do_POST = _refuse
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def _run_once(home, proxy, arrivals, timeout):
+    env = dict(os.environ)
+    env.update({'HOME': home,
+                'XDG_CONFIG_HOME': os.path.join(home, '.config'),
+                'HTTP_PROXY': proxy, 'HTTPS_PROXY': proxy,
+                'http_proxy': proxy, 'https_proxy': proxy})
+    env.pop('NO_PROXY', None)
+    env.pop('no_proxy', None)
+
+    del arrivals[:]
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, _script, os.path.join(home, 'auth.txt')], cwd=home, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    if not arrivals:
+        raise RuntimeError('the script exited without making a request')
+    return arrivals[0] - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='time from process start to first network request')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    arrivals = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _handler(arrivals))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    proxy = f'http://127.0.0.1:{server.server_port}'
+
+    with tempfile.TemporaryDirectory(prefix='reddit_image_download.startup.') as home:
+        with open(os.path.join(home, 'auth.txt'), 'w') as f:
+            f.write('client-id\nclient-secret\n')
+        # the first run also writes the config and creates the database
+        first = _run_once(home, proxy, arrivals, args.timeout)
+        warm = [_run_once(home, proxy, arrivals, args.timeout) for _ in range(args.runs)]
+    server.shutdown()
+
+    report = {'first_run_seconds': first,
+              'median_seconds': statistics.median(warm),
+              'min_seconds': min(warm),
+              'runs': warm}
+    print(f"first run {first * 1000:.0f} ms, then median {report['median_seconds'] * 1000:.0f} ms, "
+          f"min {report['min_seconds'] * 1000:.0f} ms over {len(warm)} runs")
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,3 @@
-import praw
-
 class Auth:
     def __init__(self):
         self.client_id = None
@@ -13,6 +11,8 @@ class Auth:
             self.client_secret = lines[1].strip()
             
     def login(self):
+        # praw is slow to import and only needed once there is a listing to get
+        import praw
         r = praw.Reddit(client_id=self.client_id, 
                         client_secret=self.client_secret, 
                         user_agent=self.user_agent)
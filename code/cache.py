@@ -0,0 +1,110 @@
+from code.session import Download
+from code import metrics
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+
+class OriginalCache:
+    def __init__(self, directory, max_bytes, revalidate, log):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self.revalidate = revalidate
+        self._log = log
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path in self._data_files())
+        # entries handed out and not yet rendered; eviction leaves them alone
+        self._pinned = set()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, cp, log):
+        if not cp.getboolean('cache', 'enabled'):
+            return None
+        directory = os.path.expanduser(cp['paths']['cache'])
+        return cls(directory, cp.getint('cache', 'size-mb') * 1024 * 1024,
+                   cp.getboolean('cache', 'revalidate'), log)
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self._directory, key)
+        return base, base + '.json'
+
+    def _data_files(self):
+        for entry in os.scandir(self._directory):
+            if entry.is_file() and not entry.name.endswith('.json'):
+                yield entry.path
+
+    def lookup(self, url):
+        data_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, 'r') as f:
+                entry = json.load(f)
+            with self._lock:
+                # the data file's mtime is its place in the LRU order
+                os.utime(data_path)
+                self._pinned.add(data_path)
+                self.hits += 1
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            metrics.count('cache-lookups', result='miss')
+            return None
+        metrics.count('cache-lookups', result='hit')
+        entry['path'] = data_path
+        return entry
+
+    def load(self, url, entry):
+        download = Download(entry['image_url'], entry['path'], entry['size'])
+        download.total_bytes = 0
+        download.sha256 = entry['sha256']
+        download.etag = entry['etag']
+        download.last_modified = entry['last_modified']
+        download.temporary = False
+        return download
+
+    def store(self, url, download):
+        data_path, meta_path = self._paths(url)
+        entry = {'url': url,
+                 'image_url': download.url,
+                 'size': download.size,
+                 'sha256': download.sha256,
+                 'etag': download.etag,
+                 'last_modified': download.last_modified}
+        with self._lock:
+            if os.path.exists(data_path):
+                self._size -= os.path.getsize(data_path)
+            shutil.move(download.path, data_path)
+            with open(meta_path, 'w') as f:
+                json.dump(entry, f)
+            self._size += download.size
+            download.path = data_path
+            download.temporary = False
+            self._pinned.add(data_path)
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def unpin(self, path):
+        with self._lock:
+            self._pinned.discard(path)
+
+    def _evict(self):
+        by_age = sorted(self._data_files(), key=lambda path: os.stat(path).st_mtime)
+        for path in by_age:
+            if self._size <= self._max_bytes:
+                break
+            if path in self._pinned:
+                continue
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                os.remove(path + '.json')
+            except FileNotFoundError:
+                continue
+            self._size -= size
+            self._log.debug("evicted %s from the download cache", path)
@@ -1,9 +1,50 @@
-from profanityfilter import ProfanityFilter
-from copy import deepcopy
-import concurrent.futures
+import functools
+import re
+
+_memo_size = 4096
+
+
+class _Matcher:
+    # ProfanityFilter.censor builds and compiles one regex per word on every
+    # call; this compiles them once, plus a single alternation of all of them
+    # that rules out the (usual) case of nothing to censor in one search
+    def __init__(self, pf):
+        from profanityfilter.profanityfilter import STARTS_WITH_WORD_CHAR, ENDS_WITH_WORD_CHAR, RE_ESCAPED_CHAR
+        self.patterns = []
+        for word in pf.get_profane_words():
+            regex_string = word
+            if not pf._no_word_boundaries:
+                if STARTS_WITH_WORD_CHAR.search(word):
+                    regex_string = r'\b' + regex_string
+                if ENDS_WITH_WORD_CHAR.search(word):
+                    regex_string = regex_string + r'\b'
+            self.patterns.append((regex_string, len(RE_ESCAPED_CHAR.sub("\1", word))))
+        self.any = re.compile('|'.join(f'(?:{p})' for p, _ in self.patterns), re.IGNORECASE)
+        self.compiled = [(re.compile(p, re.IGNORECASE), length) for p, length in self.patterns]
+
+
+class _CompiledCensor:
+    def __init__(self, matcher, censor_char):
+        self._matcher = matcher
+        self._replacements = [(regex, censor_char * length) for regex, length in matcher.compiled]
+        self.censor = functools.lru_cache(maxsize=_memo_size)(self._censor)
+
+    def _censor(self, text):
+        if not self._matcher.any.search(text):
+            return text
+        # replacing one word can expose another (a new word boundary, or
+        # letters joined up by an erased word), so once there is anything to
+        # censor the words are applied one by one, in ProfanityFilter's order
+        for regex, replacement in self._replacements:
+            text = regex.sub(replacement, text)
+        return text
+
 
 class Censor:
+    # profanityfilter is only imported once a censor is needed, which is when
+    # there is something to download
     def __init__(self, cp):
+        from profanityfilter import ProfanityFilter
         censors = {False: ProfanityFilter(no_word_boundaries=True),
                    True:  ProfanityFilter(no_word_boundaries=False)}
         twoLetterWords = [item for item in censors[False]._censor_list if len(item) <= 2]
@@ -14,16 +55,19 @@ class Censor:
                     pf.remove_word(word)
                 except ValueError:
                     pass
-        
+
+        matchers = {}
         self._censors = {}
         for cat in ('title', 'user', 'subreddit'):
             section = f'{cat}-language-filter'
             if cp.getboolean(section, 'filter'):
-                self._censors[cat] = censors[cp.getboolean(section, 'wholeword')]
+                wholeword = cp.getboolean(section, 'wholeword')
+                if wholeword not in matchers:
+                    matchers[wholeword] = _Matcher(censors[wholeword])
                 censor_char = cp[section]['character']
                 if censor_char == 'erase':
                     censor_char = ''
-                self._censors[cat].set_censor(censor_char)
+                self._censors[cat] = _CompiledCensor(matchers[wholeword], censor_char)
 
 
     def censor_record(self, record, log):
@@ -1,6 +1,7 @@
 from xdg import XDG_CONFIG_HOME
 from configparser import ConfigParser
 import os
+import io
 import pathlib
 
 _default_conf = """
@@ -29,6 +30,16 @@ size=28
 name=/usr/share/fonts/truetype/roboto/hinted/Roboto-Black.ttf
 size=12
 
+[output]
+format=jpeg
+quality=100
+progressive=no
+optimize=no
+subsampling=
+webp-method=4
+target-kb=0
+min-quality=60
+
 [subreddit-language-filter]
 filter=yes
 character=erase
@@ -47,15 +58,82 @@ wholeword=yes
 [allow]
 over18=no
 
+[filters]
+domains=
+
+[url-filters]
+
 [paths]
 images=~/reddit_images
 database=.images.db
+cache=~/.cache/reddit_image_download
 
 [logging]
 level=info
 
 [rate-limit]
 seconds=2
+burst=1
+
+[host-rate-limits]
+
+[retry]
+attempts=3
+backoff=1
+max-backoff=30
+defer-minutes=30
+max-deferrals=5
+
+[circuit-breaker]
+failures=5
+cooldown=300
+
+[resolver]
+ttl-days=30
+
+[daemon]
+interval-minutes=15
+
+[retention]
+posts-days=37
+excluded-days=37
+batch=1000
+
+[retention-by-reason]
+unpopular=14
+
+[cache]
+enabled=no
+size-mb=2048
+revalidate=yes
+
+[dedup]
+perceptual=no
+distance=4
+
+[maintenance]
+free-fraction=0.25
+vacuum-days=30
+optimize-days=1
+
+[download]
+workers=4
+max-bytes=52428800
+max-page-bytes=2097152
+
+[render]
+workers=0
+queue=8
+
+[http]
+connect-timeout=10
+read-timeout=30
+connections-per-host=4
+hosts=10
+
+[metrics]
+json=
+prometheus=
 """
 
 def getConfigDirectory():
@@ -77,10 +155,14 @@ def _confPath(directory, name):
         name = 'reddit_image_download.conf'
     return path / name
 
-def getConfig(name=None, directory=None, log=None):
-    filePath = _confPath(name, directory)
+def getDefaultConfig():
     cp = ConfigParser()
     cp.read_string(_default_conf)
+    return cp
+
+def getConfig(name=None, directory=None, log=None):
+    filePath = _confPath(name, directory)
+    cp = getDefaultConfig()
     cp.read(filePath)
     if log is not None:
         log.info("read config file %s", filePath)
@@ -90,11 +172,22 @@ def writeConfig(cp, name=None, directory=None, log=None):
     fileDir = _confDir(directory)
     filePath = _confPath(name, directory)
 
+    text = io.StringIO()
+    cp.write(text)
+    text = text.getvalue()
+
     try:
+        # rewriting an unchanged file only costs a write and an mtime change
+        if os.path.exists(filePath):
+            with open(filePath, 'r') as f:
+                if f.read() == text:
+                    if log is not None:
+                        log.debug("config unchanged")
+                    return
         if not os.path.exists(fileDir):
             os.makedirs(fileDir)
         with open(filePath, 'w') as f:
-            cp.write(f)
+            f.write(text)
             if log is not None:
                 log.debug("wrote config")
     except:
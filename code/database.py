@@ -1,8 +1,14 @@
 import sqlite3
 import os.path
+import collections
+
+# DELETE ... RETURNING is new in SQLite 3.35
+_has_returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+Registration = collections.namedtuple('Registration', ['new', 'refreshed', 'seen_at'])
 
 class Database:
-    _this_version = 1
+    _this_version = 9
     _ext = '.db'
 
     def __init__(self, filename):
@@ -11,42 +17,135 @@ class Database:
         self._filename = filename
         self._con = sqlite3.connect(filename)
         self._con.row_factory = sqlite3.Row
-        self._update_to_next_rev = [self._update_from_ver0]
+        self._update_to_next_rev = [self._update_from_ver0,
+                                    self._update_from_ver1,
+                                    self._update_from_ver2,
+                                    self._update_from_ver3,
+                                    self._update_from_ver4,
+                                    self._update_from_ver5,
+                                    self._update_from_ver6,
+                                    self._update_from_ver7,
+                                    self._update_from_ver8]
         self._prepare_database()
 
     
     def _prepare_database(self):
         version = 0
+        self._configure_connection()
     
         with self._con:
             version = self._con.execute("PRAGMA user_version").fetchone()[0]
     
         if version > self._this_version:
-            raise Exception(f'Database version {version} is newer than script version {_this_version}')
+            raise Exception(f'Database version {version} is newer than script version {self._this_version}')
     
         for ver in range(version, self._this_version):
             self._update_to_next_rev[ver]()
     
-        self._clean_database()
+    
+    def _cutoff(self, num_days):
+        # computed once, so the comparisons it is used in can use an index
+        return self._con.execute("SELECT datetime('now', '-' || ? || ' days')", (num_days,)).fetchone()[0]
+    
+    
+    def _purge(self, select_ids, params, batch_size):
+        # deletes the posts whose ids select_ids returns, a batch per
+        # transaction, along with every row that refers to them (foreign keys
+        # are enforced); returns the postcode and title of each
+        result = []
+        while True:
+            with self._con:
+                self._con.execute("""   DROP TABLE IF EXISTS
+                                            temp.purge""")
+                self._con.execute("""   CREATE TABLE
+                                            temp.purge(
+                                                id INTEGER PRIMARY KEY)""")
+                c = self._con.execute(f"""  INSERT INTO
+                                                temp.purge
+                                            {select_ids}
+                                            LIMIT ?""",
+                                      params + (batch_size,))
+                count = c.rowcount
+                for table in ('localfiles', 'excluded', 'contenthashes', 'retries'):
+                    self._con.execute(f"""  DELETE FROM
+                                                {table}
+                                            WHERE
+                                                postid IN
+                                                    (   SELECT
+                                                            id
+                                                        FROM
+                                                            temp.purge)""")
+                if _has_returning:
+                    c = self._con.execute("""   DELETE FROM
+                                                    posts
+                                                WHERE
+                                                    id IN
+                                                        (   SELECT
+                                                                id
+                                                            FROM
+                                                                temp.purge)
+                                                RETURNING
+                                                    postcode, title""")
+                    result.extend(c.fetchall())
+                else:
+                    c = self._con.execute("""   SELECT
+                                                    postcode, title
+                                                FROM
+                                                    posts
+                                                WHERE
+                                                    id IN
+                                                        (   SELECT
+                                                                id
+                                                            FROM
+                                                                temp.purge)""")
+                    result.extend(c.fetchall())
+                    self._con.execute("""   DELETE FROM
+                                                posts
+                                            WHERE
+                                                id IN
+                                                    (   SELECT
+                                                            id
+                                                        FROM
+                                                            temp.purge)""")
+                self._con.execute("""DROP TABLE temp.purge""")
+            if count < batch_size:
+                return result
+    
+    
+    def purge_unseen_posts(self, num_days, batch_size=1000):
+        return self._purge("""  SELECT
+                                    id
+                                FROM
+                                    posts
+                                WHERE
+                                    lastseen < ?""",
+                           (self._cutoff(num_days),), batch_size)
+    
+    
+    def purge_excluded_posts(self, reason, num_days, batch_size=1000):
+        # only posts that have been out of the listing for as long as they
+        # have been excluded, so nothing still listed is downloaded again
+        cutoff = self._cutoff(num_days)
+        return self._purge("""  SELECT
+                                    posts.id
+                                FROM
+                                    excluded
+                                    JOIN posts
+                                        ON posts.id = excluded.postid
+                                WHERE
+                                    excluded.reason = ?
+                                    AND excluded.timestamp < ?
+                                    AND posts.lastseen < ?""",
+                           (reason, cutoff, cutoff), batch_size)
     
     
-    def delete_very_old_entries(self, num_days):
+    def get_exclusion_reasons(self):
         with self._con:
-            where_query = """"""
-            c = self._con.execute("""   SELECT 
-                                            postcode, title
-                                        FROM 
-                                            posts
-                                        WHERE
-                                            lastseen < datetime('now', '-' || ? || ' days')""",
-                                  (num_days,))
-            result = c.fetchall()
-            self._con.execute("""   DELETE FROM
-                                        posts
-                                    WHERE
-                                        lastseen < datetime('now', '-' || ? || ' days')""",
-                              (num_days,))
-            return result
+            c = self._con.execute("""   SELECT DISTINCT
+                                            reason
+                                        FROM
+                                            excluded""")
+            return [row[0] for row in c.fetchall()]
             
             
     def _get_exclusion_sequence(self):
@@ -62,25 +161,21 @@ class Database:
     def exclude_old_entries(self, num_days):
         with self._con:
             seq = self._get_exclusion_sequence() + 1
+            cutoff = self._cutoff(num_days)
             self._con.execute("""   INSERT OR IGNORE INTO 
-                                        excluded
+                                        excluded(postid, sequence, reason, timestamp)
                                     SELECT 
-                                        posts.id, ?, 'old'
+                                        postid, ?, 'old', CURRENT_TIMESTAMP
                                     FROM
-                                        posts
-                                        JOIN localfiles
-                                            ON posts.id = localfiles.postid
+                                        localfiles
                                     WHERE
-                                        localfiles.timestamp < datetime('now', '-' || ? || ' days')""",
-                              (seq, num_days))
+                                        timestamp < ?""",
+                              (seq, cutoff))
             self._con.execute("""   DELETE FROM
                                         localfiles
                                     WHERE 
-                                        postid IN
-                                            (   SELECT 
-                                                    postid 
-                                                FROM
-                                                    excluded)""")
+                                        timestamp < ?""",
+                              (cutoff,))
             c = self._con.execute("""   SELECT
                                             postcode, title
                                         FROM 
@@ -92,36 +187,33 @@ class Database:
             return c.fetchall()
             
             
-    def exclude_unpopular_urls(self, urllist):
+    def exclude_unpopular_urls(self, registration):
+        # everything in the listing was stamped with registration.seen_at, so
+        # anything older has fallen out of the top posts
         with self._con:
             seq = self._get_exclusion_sequence() + 1
-            self._con.execute("""   DROP TABLE IF EXISTS
-                                        temp.urls_to_remove""")
-            self._con.execute("""   CREATE TABLE
-                                        temp.urls_to_remove
-                                    AS
-                                        SELECT
-                                            url, id, postcode, title
+            c = self._con.execute("""   SELECT
+                                            url, postcode, title
                                         FROM
                                             posts
                                         WHERE
-                                            id NOT IN
-                                                (   SELECT 
+                                            lastseen < ?
+                                            AND id NOT IN
+                                                (   SELECT
                                                         postid
                                                     FROM
-                                                        excluded)""")
-            self._con.executemany("""   DELETE FROM
-                                            temp.urls_to_remove
-                                        WHERE
-                                            url = ?""",
-                                  ((url,) for url in urllist))
+                                                        excluded)""",
+                                  (registration.seen_at,))
+            result = c.fetchall()
             self._con.execute("""   INSERT OR IGNORE INTO
-                                        excluded
+                                        excluded(postid, sequence, reason, timestamp)
                                     SELECT
-                                        id, ?, 'unpopular'
+                                        id, ?, 'unpopular', CURRENT_TIMESTAMP
                                     FROM
-                                        temp.urls_to_remove""",
-                              (seq,))
+                                        posts
+                                    WHERE
+                                        lastseen < ?""",
+                              (seq, registration.seen_at))
             self._con.execute("""   DELETE FROM
                                         localfiles
                                     WHERE
@@ -129,14 +221,10 @@ class Database:
                                             (   SELECT
                                                     postid
                                                 FROM
-                                                    excluded)""")
-            c = self._con.execute("""   SELECT
-                                            url, postcode, title
-                                        FROM
-                                            temp.urls_to_remove""")
-            result = c.fetchall()
-            self._con.execute("""DROP TABLE temp.urls_to_remove""")
-            
+                                                    excluded
+                                                WHERE
+                                                    sequence = ?)""",
+                              (seq,))
             return result
     
     
@@ -144,9 +232,9 @@ class Database:
         with self._con:
             seq = self._get_exclusion_sequence() + 1
             self._con.execute("""   INSERT OR REPLACE INTO
-                                        excluded
+                                        excluded(postid, sequence, reason, timestamp)
                                     SELECT
-                                        id, ?, ?
+                                        id, ?, ?, CURRENT_TIMESTAMP
                                     FROM
                                         posts
                                     WHERE
@@ -154,6 +242,64 @@ class Database:
                               (seq, reason, url))
     
     
+    def defer_url(self, url, reason, minutes):
+        # the wait doubles with every failure; returns the number of failures
+        with self._con:
+            c = self._con.execute("""   SELECT
+                                            retries.failures
+                                        FROM
+                                            retries
+                                            JOIN posts
+                                                ON posts.id = retries.postid
+                                        WHERE
+                                            posts.url = ?""",
+                                  (url,))
+            row = c.fetchone()
+            failures = (row[0] if row is not None else 0) + 1
+            self._con.execute("""   INSERT OR REPLACE INTO
+                                        retries(postid, failures, retryafter, reason)
+                                    SELECT
+                                        id, ?, datetime('now', '+' || ? || ' minutes'), ?
+                                    FROM
+                                        posts
+                                    WHERE
+                                        url = ?""",
+                              (failures, minutes * 2 ** (failures - 1), reason, url))
+            return failures
+    
+    
+    def get_resolved_url(self, url, num_days):
+        with self._con:
+            c = self._con.execute("""   SELECT
+                                            imageurl
+                                        FROM
+                                            resolvedurls
+                                        WHERE
+                                            url = ?
+                                            AND timestamp >= datetime('now', '-' || ? || ' days')""",
+                                  (url, num_days))
+            row = c.fetchone()
+            return row[0] if row is not None else None
+    
+    
+    def record_resolved_url(self, url, image_url):
+        with self._con:
+            self._con.execute("""   INSERT OR REPLACE INTO
+                                        resolvedurls(url, imageurl, timestamp)
+                                    VALUES(?, ?, CURRENT_TIMESTAMP)""",
+                              (url, image_url))
+    
+    
+    def delete_expired_resolved_urls(self, num_days):
+        with self._con:
+            c = self._con.execute("""   DELETE FROM
+                                            resolvedurls
+                                        WHERE
+                                            timestamp < datetime('now', '-' || ? || ' days')""",
+                                  (num_days,))
+            return c.rowcount
+    
+    
     def set_filename(self, url, filename):
         with self._con:
             self._con.execute("""   INSERT OR REPLACE INTO
@@ -167,7 +313,7 @@ class Database:
                               (filename, url))
                                  
                                  
-    def get_next_to_download(self):
+    def get_pending_downloads(self):
         with self._con:
             c = self._con.execute("""   WITH
                                             tracked_posts
@@ -187,10 +333,16 @@ class Database:
                                             posts
                                         WHERE
                                             posts.id NOT IN tracked_posts
+                                            AND posts.id NOT IN
+                                                (   SELECT
+                                                        postid
+                                                    FROM
+                                                        retries
+                                                    WHERE
+                                                        retryafter > datetime('now'))
                                         ORDER BY
-                                            posts.id
-                                        LIMIT 1""")
-            return c.fetchone()
+                                            posts.id""")
+            return c.fetchall()
             
             
     def get_image_count(self):
@@ -202,78 +354,311 @@ class Database:
             return c.fetchone()[0]
     
     
-    def get_untracked_files(self, filelist):
+    def get_inventory(self):
+        with self._con:
+            c = self._con.execute("""   SELECT
+                                            filename, size, mtime, inode
+                                        FROM
+                                            files""")
+            return {row[0]: (row[1], row[2], row[3]) for row in c}
+    
+    
+    def update_inventory(self, changed, removed):
+        # changed is (filename, size, mtime, inode) for new and modified files
+        with self._con:
+            self._con.executemany("""   INSERT OR REPLACE INTO
+                                            files(filename, size, mtime, inode)
+                                        VALUES(?, ?, ?, ?)""",
+                                  changed)
+            self._con.executemany("""   DELETE FROM
+                                            files
+                                        WHERE
+                                            filename = ?""",
+                                  ((filename,) for filename in removed))
+    
+    
+    def get_untracked_files(self):
+        # files in the directory (as of the last inventory) that no current
+        # post refers to
+        with self._con:
+            c = self._con.execute("""   SELECT
+                                            filename
+                                        FROM
+                                            files
+                                        WHERE
+                                            filename NOT IN
+                                                (   SELECT
+                                                        filename
+                                                    FROM
+                                                        localfiles
+                                                    WHERE
+                                                        postid NOT IN
+                                                            (   SELECT
+                                                                    postid
+                                                                FROM
+                                                                    excluded))""")
+            return [item[0] for item in c.fetchall() if not os.path.splitext(item[0])[1].startswith(self._ext)]
+    
+    
+    def get_metadata(self, key):
         with self._con:
+            c = self._con.execute("""   SELECT
+                                            value
+                                        FROM
+                                            metadata
+                                        WHERE
+                                            key = ?""",
+                                  (key,))
+            row = c.fetchone()
+            return row[0] if row is not None else None
+    
+    
+    def set_metadata(self, key, value):
+        with self._con:
+            self._con.execute("""   INSERT OR REPLACE INTO
+                                        metadata(key, value)
+                                    VALUES(?, ?)""",
+                              (key, value))
+    
+    
+    def register_post(self, url, title, user, subreddit, postcode):
+        return self.register_posts([(url, title, user, subreddit, postcode)])
+    
+    
+    def register_posts(self, posts):
+        with self._con:
+            seen_at = self._con.execute("SELECT datetime('now')").fetchone()[0]
             self._con.execute("""   DROP TABLE IF EXISTS
-                                        temp.files_in_directory""")
+                                        temp.listing""")
             self._con.execute("""   CREATE TABLE
-                                        temp.files_in_directory(
-                                            filename TEXT PRIMARY KEY)""")
-            self._con.executemany("""   INSERT INTO
-                                            temp.files_in_directory
-                                        VALUES(?)""",
-                                  ((filename,) for filename in filelist))
-            c = self._con.execute("""   WITH
-                                            valid_files
-                                        AS
+                                        temp.listing(
+                                            url        TEXT PRIMARY KEY,
+                                            title      TEXT,
+                                            user       TEXT,
+                                            subreddit  TEXT,
+                                            postcode   TEXT)""")
+            self._con.executemany("""   INSERT OR IGNORE INTO
+                                            temp.listing
+                                        VALUES(?, ?, ?, ?, ?)""",
+                                  posts)
+            c = self._con.execute("""   SELECT
+                                            url
+                                        FROM
+                                            temp.listing
+                                        WHERE
+                                            url IN
+                                                (   SELECT
+                                                        url
+                                                    FROM
+                                                        posts)""")
+            refreshed = [item[0] for item in c.fetchall()]
+            self._con.execute("""   INSERT OR IGNORE INTO
+                                        posts(title, user, subreddit, url, postcode, lastseen)
+                                    SELECT
+                                        title, user, subreddit, url, postcode, ?
+                                    FROM
+                                        temp.listing""",
+                              (seen_at,))
+            self._con.execute("""   UPDATE
+                                        posts
+                                    SET
+                                        lastseen = ?
+                                    WHERE
+                                        url IN
                                             (   SELECT
-                                                    filename
+                                                    url
                                                 FROM
-                                                    localfiles
-                                                WHERE
-                                                    postid NOT IN
-                                                        (   SELECT
-                                                                postid
-                                                            FROM
-                                                                excluded))
-                                        SELECT
-                                            filename
+                                                    temp.listing)""",
+                              (seen_at,))
+            c = self._con.execute("""   SELECT
+                                            url
                                         FROM
-                                            valid_files
+                                            temp.listing
                                         WHERE
-                                            filename IN temp.files_in_directory""")
-            result = [item[0] for item in c.fetchall() if not os.path.splitext(item[0])[1].startswith(self._ext)]
-            self._con.execute("""DROP TABLE temp.files_in_directory""")
-            return result
+                                            url IN
+                                                (   SELECT
+                                                        url
+                                                    FROM
+                                                        posts)""")
+            already_known = set(refreshed)
+            new = [item[0] for item in c.fetchall() if item[0] not in already_known]
+            self._con.execute("""DROP TABLE temp.listing""")
+            return Registration(new, refreshed, seen_at)
     
     
-    def register_post(self, url, title, user, subreddit, postcode):
+    def refresh_lastseen(self, posts):
+        # for a listing with the same posts as the last one registered, where
+        # nothing but the time they were last seen changes
         with self._con:
-           self._con.execute("""INSERT OR IGNORE INTO
-                                    posts(title, user, subreddit, url, postcode, lastseen)
-                                VALUES(?, ?, ?, ?, ?, CURRENT_TIMESTAMP)""",
-                             (title, user, subreddit, url, postcode))
-           self._con.execute("""UPDATE
-                                    posts
-                                SET
-                                    lastseen = CURRENT_TIMESTAMP
-                                WHERE
-                                    url = ?""",
-                             (url,))
+            seen_at = self._con.execute("SELECT datetime('now')").fetchone()[0]
+            self._con.execute("""   DROP TABLE IF EXISTS
+                                        temp.listing""")
+            self._con.execute("""   CREATE TABLE
+                                        temp.listing(
+                                            url        TEXT PRIMARY KEY)""")
+            self._con.executemany("""   INSERT OR IGNORE INTO
+                                            temp.listing
+                                        VALUES(?)""",
+                                  ((post[0],) for post in posts))
+            self._con.execute("""   UPDATE
+                                        posts
+                                    SET
+                                        lastseen = ?
+                                    WHERE
+                                        url IN
+                                            (   SELECT
+                                                    url
+                                                FROM
+                                                    temp.listing)""",
+                              (seen_at,))
+            self._con.execute("""DROP TABLE temp.listing""")
+            return seen_at
     
     
-    def track_image(self, url, filename):
+    def track_image(self, url, filename, fingerprint=None, encoder=None):
         with self._con:
+            self._con.execute("""   DELETE FROM
+                                        retries
+                                    WHERE
+                                        postid IN
+                                            (   SELECT
+                                                    id
+                                                FROM
+                                                    posts
+                                                WHERE
+                                                    url = ?)""",
+                              (url,))
             self._con.execute("""   INSERT OR IGNORE INTO
+                                        localfiles(postid, filename, timestamp, fingerprint, encoder)
+                                    SELECT
+                                        id, ?, CURRENT_TIMESTAMP, ?, ?
+                                    FROM
+                                        posts
+                                    WHERE
+                                        url = ?""",
+                              (filename, fingerprint, encoder, url))
+    
+    
+    def get_stale_images(self, fingerprint):
+        with self._con:
+            c = self._con.execute("""   SELECT
+                                            posts.*, localfiles.filename
+                                        FROM
+                                            posts
+                                            JOIN localfiles
+                                                ON posts.id = localfiles.postid
+                                        WHERE
+                                            localfiles.fingerprint IS NOT ?
+                                        ORDER BY
+                                            posts.id""",
+                                  (fingerprint,))
+            return c.fetchall()
+    
+    
+    def set_fingerprint(self, url, filename, fingerprint, encoder=None):
+        with self._con:
+            self._con.execute("""   UPDATE
                                         localfiles
+                                    SET
+                                        filename = ?,
+                                        fingerprint = ?,
+                                        encoder = ?
+                                    WHERE
+                                        postid IN
+                                            (   SELECT
+                                                    id
+                                                FROM
+                                                    posts
+                                                WHERE
+                                                    url = ?)""",
+                              (filename, fingerprint, encoder, url))
+    
+    
+    def record_hash(self, url, sha256, phash):
+        with self._con:
+            self._con.execute("""   INSERT OR REPLACE INTO
+                                        contenthashes(postid, sha256, phash)
                                     SELECT
-                                        id, ?, CURRENT_TIMESTAMP
+                                        id, ?, ?
                                     FROM
                                         posts
                                     WHERE
                                         url = ?""",
-                              (filename, url))
+                              (sha256, phash, url))
+    
+    
+    def get_content_hashes(self):
+        with self._con:
+            c = self._con.execute("""   SELECT
+                                            posts.postcode, posts.url, contenthashes.sha256, contenthashes.phash
+                                        FROM
+                                            contenthashes
+                                            JOIN posts
+                                                ON posts.id = contenthashes.postid
+                                        WHERE
+                                            contenthashes.postid NOT IN
+                                                (   SELECT
+                                                        postid
+                                                    FROM
+                                                        excluded)""")
+            return c.fetchall()
+    
+    
+    def get_free_page_fraction(self):
+        with self._con:
+            free_pages = self._con.execute("PRAGMA freelist_count").fetchone()[0]
+            total_pages = self._con.execute("PRAGMA page_count").fetchone()[0]
+            return free_pages / total_pages if total_pages else 0.0
+    
+    
+    def maintenance_due(self, task, num_days):
+        with self._con:
+            c = self._con.execute("""   SELECT
+                                            value
+                                        FROM
+                                            metadata
+                                        WHERE
+                                            key = ?
+                                            AND value >= datetime('now', '-' || ? || ' days')""",
+                                  (f'last-{task}', num_days))
+            return c.fetchone() is None
+    
+    
+    def record_maintenance(self, task):
+        with self._con:
+            self._con.execute("""   INSERT OR REPLACE INTO
+                                        metadata(key, value)
+                                    VALUES(?, datetime('now'))""",
+                              (f'last-{task}',))
+    
+    
+    def incremental_vacuum(self):
+        # the pragma frees one page per step, and the module's execute only
+        # steps a statement without result columns once, so this goes through
+        # executescript, which runs it to the end; returns the number of free
+        # pages before and after
+        before = self._con.execute("PRAGMA freelist_count").fetchone()[0]
+        self._con.executescript("PRAGMA incremental_vacuum")
+        after = self._con.execute("PRAGMA freelist_count").fetchone()[0]
+        return before, after
+        
+        
+    def vacuum(self):
+        self._con.execute("VACUUM")
+        self.record_maintenance('vacuum')
+        
+        
+    def optimize(self):
+        self._con.execute("PRAGMA optimize")
+        self.record_maintenance('optimize')
     
     
     def _update_from_ver0(self):
-        # Nothing needs to be done for this case
         try:
             os.remove(".reddit_image_data")
         except:
             pass
-    
-    
-    def _clean_database(self):
+
         with self._con:
             self._con.execute("""CREATE TABLE IF NOT EXISTS posts(
                                  id         INTEGER  PRIMARY KEY   AUTOINCREMENT,
@@ -297,9 +682,102 @@ class Database:
                                  ON localfiles(postid)""")
             self._con.execute("""CREATE UNIQUE INDEX IF NOT EXISTS localfiles_filename_index
                                  ON localfiles(filename)""")
-            
-            self._con.execute("VACUUM")
             self._con.execute("PRAGMA user_version = 1")
-            self._con.execute("PRAGMA foreign_keys = ON")
+    
+    
+    def _update_from_ver1(self):
+        with self._con:
+            self._con.execute("""CREATE TABLE IF NOT EXISTS metadata(
+                                 key        TEXT     PRIMARY KEY,
+                                 value      TEXT)""")
+            self._con.execute("PRAGMA user_version = 2")
 
+        # auto_vacuum only takes effect on an existing database after a
+        # full VACUUM; this is the last one that runs unconditionally
+        self._con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.vacuum()
+    
+    
+    def _update_from_ver2(self):
+        with self._con:
+            self._con.execute("""CREATE TABLE IF NOT EXISTS contenthashes(
+                                 postid     INTEGER  PRIMARY KEY   REFERENCES posts(id),
+                                 sha256     TEXT     NOT NULL,
+                                 phash      TEXT)""")
+            self._con.execute("""CREATE INDEX IF NOT EXISTS contenthashes_sha256_index
+                                 ON contenthashes(sha256)""")
+            self._con.execute("PRAGMA user_version = 3")
+    
+    
+    def _update_from_ver3(self):
+        with self._con:
+            # NULL for files rendered before fingerprints were recorded
+            self._con.execute("""ALTER TABLE localfiles ADD COLUMN fingerprint TEXT""")
+            self._con.execute("PRAGMA user_version = 4")
+    
+    
+    def _update_from_ver4(self):
+        with self._con:
+            self._con.execute("""CREATE TABLE IF NOT EXISTS retries(
+                                 postid     INTEGER  PRIMARY KEY   REFERENCES posts(id),
+                                 failures   INTEGER  NOT NULL,
+                                 retryafter DATETIME NOT NULL,
+                                 reason     TEXT)""")
+            self._con.execute("""CREATE INDEX IF NOT EXISTS retries_retryafter_index
+                                 ON retries(retryafter)""")
+            self._con.execute("PRAGMA user_version = 5")
+    
+    
+    def _update_from_ver5(self):
+        with self._con:
+            # keyed by url rather than post, since the same page can be
+            # posted more than once
+            self._con.execute("""CREATE TABLE IF NOT EXISTS resolvedurls(
+                                 url        TEXT     PRIMARY KEY,
+                                 imageurl   TEXT     NOT NULL,
+                                 timestamp  DATETIME NOT NULL)""")
+            self._con.execute("PRAGMA user_version = 6")
+    
+    
+    def _update_from_ver6(self):
+        with self._con:
+            # files from before this were all written as quality 100 JPEG
+            self._con.execute("""ALTER TABLE localfiles ADD COLUMN encoder TEXT""")
+            self._con.execute("""UPDATE localfiles SET encoder = 'jpeg'""")
+            self._con.execute("PRAGMA user_version = 7")
+    
+    
+    def _update_from_ver7(self):
+        with self._con:
+            # what was in the image directory at the last scan; mtime is in
+            # nanoseconds
+            self._con.execute("""CREATE TABLE IF NOT EXISTS files(
+                                 filename   TEXT     PRIMARY KEY,
+                                 size       INTEGER  NOT NULL,
+                                 mtime      INTEGER  NOT NULL,
+                                 inode      INTEGER  NOT NULL)""")
+            self._con.execute("PRAGMA user_version = 8")
+    
+    
+    def _update_from_ver8(self):
+        with self._con:
+            # ALTER TABLE can't add a column with a CURRENT_TIMESTAMP default;
+            # existing exclusions are dated to the upgrade
+            self._con.execute("""ALTER TABLE excluded ADD COLUMN timestamp DATETIME""")
+            self._con.execute("""UPDATE excluded SET timestamp = CURRENT_TIMESTAMP""")
+            self._con.execute("""CREATE INDEX IF NOT EXISTS excluded_reason_timestamp_index
+                                 ON excluded(reason, timestamp)""")
+            self._con.execute("""CREATE INDEX IF NOT EXISTS posts_lastseen_index
+                                 ON posts(lastseen)""")
+            self._con.execute("""CREATE INDEX IF NOT EXISTS localfiles_timestamp_index
+                                 ON localfiles(timestamp)""")
+            self._con.execute("PRAGMA user_version = 9")
+    
+    
+    def _configure_connection(self):
+        # one writer, and a lost last transaction after a power cut only
+        # means a few images get fetched again
+        self._con.execute("PRAGMA journal_mode = WAL")
+        self._con.execute("PRAGMA synchronous = NORMAL")
+        self._con.execute("PRAGMA foreign_keys = ON")
 
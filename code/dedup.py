@@ -0,0 +1,77 @@
+_hash_size = 8
+
+
+def perceptual_hash(path):
+    # difference hash: one bit per horizontally adjacent pixel pair of a
+    # 9x8 grayscale thumbnail
+    from PIL import Image
+    with Image.open(path) as im:
+        im.draft('L', (_hash_size * 8, _hash_size * 8))
+        small = im.convert('L').resize((_hash_size + 1, _hash_size), Image.ANTIALIAS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(_hash_size):
+        for col in range(_hash_size):
+            left = pixels[row * (_hash_size + 1) + col]
+            right = pixels[row * (_hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f'{bits:016x}'
+
+
+def _distance(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+class HashIndex:
+    # the content hashes of the images kept so far, loaded once per run.  Two
+    # 64-bit hashes within distance d agree exactly on at least one of d + 1
+    # slices of the bits, so only hashes sharing a slice value with the new
+    # one are compared
+    def __init__(self, max_distance):
+        self._max_distance = max_distance
+        pieces = min(max(max_distance, 0), _hash_size * _hash_size - 1) + 1
+        width, extra = divmod(_hash_size * _hash_size, pieces)
+        self._slices = []
+        shift = 0
+        for i in range(pieces):
+            bits = width + (i < extra)
+            self._slices.append((shift, (1 << bits) - 1))
+            shift += bits
+        self._by_sha256 = {}
+        self._buckets = {}
+
+    @classmethod
+    def from_database(cls, db, cp):
+        index = cls(cp.getint('dedup', 'distance'))
+        for item in db.get_content_hashes():
+            index.add(item['url'], item['postcode'], item['sha256'], item['phash'])
+        return index
+
+    def _keys(self, phash):
+        bits = int(phash, 16)
+        return [(i, (bits >> shift) & mask) for i, (shift, mask) in enumerate(self._slices)]
+
+    def add(self, url, postcode, sha256, phash):
+        item = {'url': url, 'postcode': postcode, 'phash': phash}
+        self._by_sha256.setdefault(sha256, item)
+        if phash is not None:
+            for key in self._keys(phash):
+                self._buckets.setdefault(key, []).append(item)
+
+    def remove(self, url, sha256, phash):
+        if self._by_sha256.get(sha256, {}).get('url') == url:
+            del self._by_sha256[sha256]
+        if phash is not None:
+            for key in self._keys(phash):
+                bucket = self._buckets.get(key, [])
+                bucket[:] = [item for item in bucket if item['url'] != url]
+
+    def find(self, sha256, phash):
+        match = self._by_sha256.get(sha256)
+        if match is not None or phash is None:
+            return match
+        for key in self._keys(phash):
+            for item in self._buckets.get(key, ()):
+                if _distance(item['phash'], phash) <= self._max_distance:
+                    return item
+        return None
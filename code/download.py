@@ -1,77 +1,148 @@
 from urllib.parse import urlparse
-import requests
+from code.retry import is_transient
+from code import session
+from code import metrics
 import re
 
-def download_image(data, log):
+
+_flickr_photo = re.compile(r'^.*flickr.com/photos/([^/]+)/([^/]+)')
+_imgur_any_image = re.compile(r'(//i\.imgur\.com/[a-zA-Z0-9]{2,}\.[^"]+)"')
+
+
+class UnresolvedPage(Exception):
+    pass
+
+
+# (name, compiled host pattern, function); a resolver turns a post's url into
+# the url of the image itself, and returns it with the bytes it fetched
+_resolvers = []
+
+def resolver(name, host_pattern):
+    def register(function):
+        _resolvers.append((name, re.compile(host_pattern), function))
+        return function
+    return register
+
+def _find_resolver(domain):
+    for name, host, function in _resolvers:
+        if host.search(domain):
+            return name, function
+    return 'direct', None
+
+
+def download_image(data, directory, log, cache=None):
     url = data['url']
     domain = urlparse(url).hostname
-    
+
     if domain is None:
-        return []
-    
-    response = []
-    if re.search(r'[^./]flickr\.com', domain):
-        response = _download_flickr(url, log)
-    elif re.search(r'[^./]imgur.com', domain):
-        response = _download_imgur(url, log)
-        
-    if not response:
-        response = _download_default(url, log)
-        
-    download_bytes = sum(len(x.content) for x in response)
-        
-    log.info("downloaded %s (%s - %s) (%d bytes)", url, data['subreddit'], data['title'], download_bytes)
-    return response
-
-def _download_flickr(url, log):
-    
+        return None
+
+    # an entry that is found stays pinned in the cache until the caller is
+    # done with the download
+    entry = cache.lookup(url) if cache is not None else None
+    if entry is not None:
+        with metrics.stage('download', resolver='cache'):
+            try:
+                return _download_cached(url, entry, data, directory, cache, log)
+            except Exception:
+                cache.unpin(entry['path'])
+                raise
+
+    # the main thread passes in what an earlier attempt resolved this url
+    # to, in which case the page is not fetched again
+    image_url = data.get('resolved_url')
+    name, resolve = _find_resolver(domain)
+    if image_url is not None:
+        name, resolve = 'known', None
+
+    with metrics.stage('download', resolver=name):
+        page_bytes = 0
+        resolved_url = None
+        if resolve is not None:
+            image_url, page_bytes = resolve(url, data, log)
+            if image_url != url:
+                resolved_url = image_url
+
+        try:
+            download = session.fetch_file(image_url or url, directory)
+        except Exception as e:
+            # what the page resolved to is still worth remembering, so a
+            # later attempt can skip fetching it again
+            e.resolved_url = resolved_url
+            raise
+        download.total_bytes += page_bytes
+        download.resolved_url = resolved_url
+        if cache is not None:
+            cache.store(url, download)
+
+    log.info("downloaded %s (%s - %s) (%d bytes)", url, data['subreddit'], data['title'], download.total_bytes)
+    return download
+
+def _download_cached(url, entry, data, directory, cache, log):
+    # the cache remembers the resolved image url, so no page fetch is needed
+    if cache.revalidate and (entry['etag'] or entry['last_modified']):
+        try:
+            download = session.fetch_file(entry['image_url'], directory, entry['etag'], entry['last_modified'])
+        except Exception as e:
+            # the cached copy is still good enough if the host is having trouble
+            if not is_transient(e):
+                raise
+            metrics.count('cache-lookups', result='stale-hit')
+            log.warning("could not revalidate %s: %s, using the cached copy", url, e)
+            download = None
+        if download is not None:
+            cache.store(url, download)
+            log.info("downloaded %s (%s - %s) (%d bytes, cached copy was stale)",
+                     url, data['subreddit'], data['title'], download.total_bytes)
+            return download
+
+    log.info("using cached %s (%s - %s)", url, data['subreddit'], data['title'])
+    return cache.load(url, entry)
+
+@resolver('flickr', r'(^|\.)flickr\.com$')
+def _resolve_flickr(url, data, log):
+
     # get flickr source if this is a base page
-    redirected = False
-    unique_id = ''
     flickr_filename = url.split('/')[-1]
-    if '.' not in flickr_filename:
-        m = re.search(r'^.*flickr.com/photos/([^/]+)/([^/]+)', url)
-        if m and m.group(2) not in ['sets', 'items']:
-            redirected = True
-            unique_id = m.group(2)
-            url = m.group(0) + '/sizes/k'
-            log.debug("new url %s", url)
-
-    response = [requests.get(url)]
-
-    if redirected:
-        m = re.search(r'//[^"]+' + unique_id + r'[^"]+_d\.[^"]+', response[0].content.decode('utf-8'))
-        if m:
-            log.debug("trying flickr redirect: %s -> %s", old_url, m.group(0))
-            response.append(requests.get("https:{}".format(m.group(0))))
-        else:
-            log.info("could not get flickr redirect for %s (%s)", url, data['title'])
-
-    return response
-
-def _download_imgur(url, log):
-    
-    response = [requests.get(url)]
-    
+    if '.' in flickr_filename:
+        return url, 0
+
+    m = _flickr_photo.search(url)
+    if not m or m.group(2) in ['sets', 'items']:
+        return url, 0
+
+    unique_id = m.group(2)
+    page_url = m.group(0) + '/sizes/k'
+    log.debug("new url %s", page_url)
+
+    page, page_bytes = session.fetch_text(page_url)
+    m = re.search(r'//[^"]+' + unique_id + r'[^"]+_d\.[^"]+', page)
+    if not m:
+        log.info("could not get flickr redirect for %s (%s)", url, data['title'])
+        raise UnresolvedPage(page_url)
+
+    log.debug("trying flickr redirect: %s -> %s", page_url, m.group(0))
+    return "https:{}".format(m.group(0)), page_bytes
+
+@resolver('imgur', r'(^|\.)imgur\.com$')
+def _resolve_imgur(url, data, log):
+
     # get imgur source if this is a base page
     imgur_filename = url.split('/')[-1]
-    if '.' not in imgur_filename:
-        # we need to get the actual imgur source file
-        m = re.search(r'(//i\.imgur\.com/{}\.[^"]+)"'.format(imgur_filename), response[0].content.decode('utf-8'))
-        if m:
-            log.debug("encountered imgur redirect: %s -> %s}", url, m.group(1))
-            response.append(requests.get("https:{}".format(m.group(1))))
-        else:
-            m = re.search(r'(//i\.imgur\.com/[a-zA-Z0-9]{2,}\.[^"]+)"', response[0].content.decode('utf-8'))
-            if m:
-                log.debug("trying album redirect: %s -> %s", url, m.group(1))
-                response.append(requests.get("https:{}".format(m.group(1))))
-            else:
-                log.info("could not get imgur redirect for %s (%s)", url, data['title'])
-
-    return response
-
-def _download_default(url, log):
-    
-    return [requests.get(url)]
-    
+    if '.' in imgur_filename:
+        return url, 0
+
+    # we need to get the actual imgur source file
+    page, page_bytes = session.fetch_text(url)
+    m = re.search(r'(//i\.imgur\.com/{}\.[^"]+)"'.format(imgur_filename), page)
+    if m:
+        log.debug("encountered imgur redirect: %s -> %s", url, m.group(1))
+        return "https:{}".format(m.group(1)), page_bytes
+
+    m = _imgur_any_image.search(page)
+    if m:
+        log.debug("trying album redirect: %s -> %s", url, m.group(1))
+        return "https:{}".format(m.group(1)), page_bytes
+
+    log.info("could not get imgur redirect for %s (%s)", url, data['title'])
+    raise UnresolvedPage(url)
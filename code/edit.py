@@ -1,32 +1,131 @@
-from PIL import Image
-from PIL import ImageFont
-from PIL import ImageDraw
+from code.encode import Encoder
+from code import metrics
+import functools
+import hashlib
 import time
 import re
 
-def edit_image(bio, data, cp, log):
+_line_spacing = 4
+_draft_factor = 2
+_render_sections = ('processing', 'title-font', 'timestamp-font', 'output')
+
+def render_fingerprint(cp):
+    # identifies the settings a rendered file was made with
+    settings = [(section, sorted(cp[section].items())) for section in _render_sections]
+    return hashlib.sha1(repr(settings).encode('utf-8')).hexdigest()[:16]
+
+def _has_alpha(im):
+    return im.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in im.info
+
+@functools.lru_cache(maxsize=None)
+def _load_font(name, size):
+    from PIL import ImageFont
+    return ImageFont.truetype(name, size)
+
+def _wrap_words(words, draw, font, max_w):
+    # Same result as growing the caption a word at a time and breaking
+    # whenever multiline_textsize of the whole string goes over max_w, but
+    # each word is measured once.  Widths of joined words are not exactly
+    # additive (kerning, bearings), so a line is only measured exactly when
+    # the estimate is within one em per estimated join of max_w.
+    word_widths = {}
+    def width(word):
+        if word not in word_widths:
+            word_widths[word] = draw.textsize(word, font)[0]
+        return word_widths[word]
+
+    space_w = width(" ")
+    em = font.size
+    lines = []
+    line = None
+    line_w = 0
+    joins = 0
+    # once any line is wider than max_w every later word starts a new line
+    overflow = False
+    for word in words:
+        if line is None:
+            line, line_w, joins = word, width(word), 0
+            overflow = overflow or line_w > max_w
+            continue
+        proposed = line + " " + word
+        estimate = line_w + space_w + width(word)
+        slack = (joins + 1) * em
+        if overflow or estimate - slack > max_w:
+            fits = False
+        elif estimate + slack <= max_w:
+            fits = True
+            line_w, joins = estimate, joins + 1
+        else:
+            line_w, joins = draw.textsize(proposed, font)[0], 0
+            fits = line_w <= max_w
+        if fits:
+            line = proposed
+        else:
+            lines.append(line)
+            line, line_w, joins = word, width(word), 0
+            overflow = overflow or line_w > max_w
+    lines.append(line)
+    return lines
+
+def edit_image(source, data, cp, log):
+    # imported here, so the main process, which only needs
+    # render_fingerprint, doesn't load PIL
+    from PIL import Image
     log.info("editing %s", data['postcode'])
-    im = Image.open(bio).convert('RGBA')
-    
-    # resize image
-    w,h = im.size
-    h_scale = cp.getfloat('processing', 'height') / h
-    w_scale = cp.getfloat('processing', 'width') / w
-    scale = min(w_scale, h_scale)
-    new_w = int(round(w * scale))
-    new_h = int(round(h * scale))
-    new_size = (new_w, new_h)
-    if scale <= 0.2:
-        im = im.resize(new_size, Image.ANTIALIAS)
-    else:
-        im = im.resize(new_size, Image.BICUBIC)
+    with metrics.stage('decode'), Image.open(source) as original:
+        # resize image
+        w,h = original.size
+        h_scale = cp.getfloat('processing', 'height') / h
+        w_scale = cp.getfloat('processing', 'width') / w
+        scale = min(w_scale, h_scale)
+        new_w = int(round(w * scale))
+        new_h = int(round(h * scale))
+        new_size = (new_w, new_h)
+
+        # let the JPEG decoder scale by 1/2, 1/4 or 1/8 while decoding, but
+        # stay at least twice the target size so the resample below still
+        # does the filtering
+        if original.format == 'JPEG' and scale < 0.5:
+            original.draft(original.mode, (new_w * _draft_factor, new_h * _draft_factor))
+            log.debug("decoding %s at %s instead of %s", data['postcode'], original.size, (w, h))
+
+        # opaque images are resized as RGB, which gives the same pixels as
+        # resizing them as RGBA at three quarters of the cost
+        if _has_alpha(original):
+            im = original.convert('RGBA')
+        else:
+            im = original.convert('RGB')
+
+    with metrics.stage('resize'):
+        if scale <= 0.2:
+            im = im.resize(new_size, Image.ANTIALIAS)
+        else:
+            im = im.resize(new_size, Image.BICUBIC)
+        im = im.convert('RGBA')
+
+    with metrics.stage('caption'):
+        rgb_result = _caption(im, data, cp, log)
+
+    encoder = Encoder.from_config(cp)
+    filename = data['postcode'] + encoder.extension
+    with metrics.stage('encode', format=encoder.name):
+        encoded = encoder.encode(rgb_result)
+    with metrics.stage('write'):
+        with open(filename, 'wb') as f:
+            f.write(encoded)
+    return filename
+
+def _caption(im, data, cp, log):
+    from PIL import Image
+    from PIL import ImageDraw
+    new_w, new_h = im.size
     overlay = Image.new('RGBA', im.size, (255,255,255,0))
     
         
     # add text
     draw = ImageDraw.Draw(overlay)
-    font = ImageFont.truetype(cp['title-font']['name'], cp.getint('title-font', 'size'))
-    timestamp_font = ImageFont.truetype(cp['timestamp-font']['name'], cp.getint('timestamp-font', 'size'))
+    font = _load_font(cp['title-font']['name'], cp.getint('title-font', 'size'))
+    timestamp_font = _load_font(cp['timestamp-font']['name'], cp.getint('timestamp-font', 'size'))
     
     txt = data['title']
     txt_before = txt   
@@ -48,35 +147,24 @@ def edit_image(bio, data, cp, log):
     if subreddit.lower().endswith('porn'):
         subreddit = subreddit[0:-4]
     words.append("(/u/{} - {})".format(data['user'], subreddit))
-    text = ""
     vert_buffer_top = 5
     vert_buffer_bottom = 10
     horiz_buffer = 10
     max_w = new_w - 2 * horiz_buffer
-    for word in words:
-        if len(text) == 0:
-            text = word
-            continue
-        proposed_size = draw.multiline_textsize(text + " " + word, font)
-        if proposed_size[0] > max_w:
-            text = text + "\n" + word
-        else:
-            text = text + " " + word
-        
-    text_size = draw.multiline_textsize(text + " " + word, font)
+    lines = _wrap_words(words, draw, font, max_w)
+    text = "\n".join(lines)
+
+    # height as multiline_textsize would report it
+    text_h = len(lines) * (draw.textsize('A', font)[1] + _line_spacing) - _line_spacing
     text_xpos = horiz_buffer
-    text_ypos = new_h - vert_buffer_bottom - text_size[1]
+    text_ypos = new_h - vert_buffer_bottom - text_h
 
     # go a few pixels up if at the bottom of the TV
     draw.rectangle(im.size + (0, text_ypos-vert_buffer_top), (0,0,0,128))
     draw.text((2, im.size[1]-timestamp_h-2),
               timestamp, fill=(255,255,255,128), font=timestamp_font)
-    draw.multiline_text((text_xpos, text_ypos),text,fill=(255,255,255),font=font)
+    draw.multiline_text((text_xpos, text_ypos),text,fill=(255,255,255),font=font,spacing=_line_spacing)
     #draw.text((0,50), text, font=font)
     result = Image.alpha_composite(im, overlay)
-    rgb_result = result.convert('RGB')
     del draw
-    filename = data['postcode'] + '.jpg'
-    rgb_result.save(filename, quality=100)
-    bio.close()
-    return filename
+    return result.convert('RGB')
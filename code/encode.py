@@ -0,0 +1,95 @@
+from code import metrics
+import io
+
+_subsampling_names = ('4:4:4', '4:2:2', '4:2:0')
+
+
+def _parse_subsampling(value):
+    # Pillow takes 0, 1 or 2, or the same as a ratio; anything else would
+    # only fail at the first save, in a render worker
+    value = value.strip()
+    if not value:
+        return None
+    if value.isdigit() and int(value) <= 2:
+        return int(value)
+    if value in _subsampling_names:
+        return value
+    raise ValueError(f'unknown subsampling {value}, expected 0, 1, 2, {", ".join(_subsampling_names)}')
+
+
+class Encoder:
+    def __init__(self, format, quality, progressive=False, optimize=False, subsampling=None,
+                 webp_method=4, target_bytes=0, min_quality=None):
+        if format not in ('jpeg', 'webp'):
+            raise ValueError(f'unknown output format {format}, expected jpeg or webp')
+        self.format = format
+        self.quality = quality
+        self.progressive = progressive
+        self.optimize = optimize
+        self.subsampling = subsampling
+        self.webp_method = webp_method
+        self.target_bytes = target_bytes
+        self.min_quality = min(quality, min_quality if min_quality is not None else quality)
+
+    @classmethod
+    def from_config(cls, cp):
+        section = cp['output']
+        return cls(section['format'].lower(),
+                   cp.getint('output', 'quality'),
+                   progressive=cp.getboolean('output', 'progressive'),
+                   optimize=cp.getboolean('output', 'optimize'),
+                   subsampling=_parse_subsampling(section['subsampling']),
+                   webp_method=cp.getint('output', 'webp-method'),
+                   target_bytes=cp.getint('output', 'target-kb') * 1024,
+                   min_quality=cp.getint('output', 'min-quality'))
+
+    @property
+    def name(self):
+        if self.format == 'jpeg' and self.progressive:
+            return 'progressive-jpeg'
+        return self.format
+
+    @property
+    def extension(self):
+        return '.jpg' if self.format == 'jpeg' else '.webp'
+
+    def _options(self, quality):
+        if self.format == 'webp':
+            return {'format': 'WEBP', 'quality': quality, 'method': self.webp_method}
+        options = {'format': 'JPEG', 'quality': quality}
+        if self.progressive:
+            options['progressive'] = True
+        if self.optimize:
+            options['optimize'] = True
+        if self.subsampling is not None:
+            options['subsampling'] = self.subsampling
+        return options
+
+    def _encode(self, im, quality):
+        metrics.count('encodes', format=self.format)
+        out = io.BytesIO()
+        im.save(out, **self._options(quality))
+        return out.getvalue()
+
+    def encode(self, im):
+        data = self._encode(im, self.quality)
+        if not self.target_bytes or len(data) <= self.target_bytes:
+            return data
+
+        # the highest quality that fits, or the lowest allowed if none does;
+        # the size falls (nearly) monotonically with quality, so bisect.  If
+        # nothing fits, the last attempt was at min_quality
+        fits, last = None, data
+        low, high = self.min_quality, self.quality - 1
+        while low <= high:
+            quality = (low + high) // 2
+            last = self._encode(im, quality)
+            if len(last) <= self.target_bytes:
+                fits = last
+                low = quality + 1
+            else:
+                high = quality - 1
+        if fits is None:
+            metrics.count('over-budget')
+            return last
+        return fits
@@ -1,4 +1,9 @@
 import os
+import time
+
+# a directory changed within this long of its last scan may have changed in
+# the same mtime tick as the scan, so its mtime is not trusted
+_racy_seconds = 2
 
 def try_remove_image(filename):
     try:
@@ -9,25 +14,35 @@ def try_remove_image(filename):
         pass
 
 
-def delete_stale_images(filenames_to_download, dataFile, log):
-    log.info("examining existing files")
-    contents = os.listdir('.')
-    keepfiles = set()
-    for filename in sorted(contents):
-        deleteFile = True
-        if os.path.isdir(filename):
-            continue
-        if filename == dataFile:
-            continue
-        for fname in [f for f in filenames_to_download if filename.startswith(f + '.')]:
-            log.debug("file %s already downloaded", fname)
-            keepfiles.add(filename)
-            deleteFile = False
-            break
-        if deleteFile:
-            log.info("deleting %s", filename)
-            os.remove(filename)
-    
-    kept = len(keepfiles)
-    log.info("keeping %d files", kept)
-    return keepfiles
+def _scan():
+    found = {}
+    with os.scandir('.') as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                found[entry.name] = (st.st_size, st.st_mtime_ns, st.st_ino)
+    return found
+
+
+def reconcile_directory(db, log):
+    # brings the inventory of the current directory in the database up to
+    # date, then deletes the files that no current post refers to
+    st = os.stat('.')
+    if db.get_metadata('directory-mtime') == str(st.st_mtime_ns):
+        log.debug("directory unchanged since the last scan")
+    else:
+        known = db.get_inventory()
+        found = _scan()
+        changed = [(name,) + info for name, info in found.items() if known.get(name) != info]
+        removed = [name for name in known if name not in found]
+        db.update_inventory(changed, removed)
+        log.debug("scanned %d files: %d new or changed, %d gone", len(found), len(changed), len(removed))
+        racy = time.time_ns() - st.st_mtime_ns < _racy_seconds * 1000000000
+        db.set_metadata('directory-mtime', '' if racy else str(st.st_mtime_ns))
+
+    untracked = db.get_untracked_files()
+    for filename in untracked:
+        try_remove_image(filename)
+        log.debug(f'deleted file {filename}')
+    db.update_inventory([], untracked)
+    return untracked
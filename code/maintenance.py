@@ -0,0 +1,17 @@
+def run_maintenance(db, cp, log):
+    expired = db.delete_expired_resolved_urls(cp.getfloat('resolver', 'ttl-days'))
+    log.debug("forgot %d resolved image urls", expired)
+
+    free = db.get_free_page_fraction()
+    log.debug("%.1f%% of database pages are free", free * 100)
+    if free >= cp.getfloat('maintenance', 'free-fraction'):
+        before, after = db.incremental_vacuum()
+        log.info("reclaimed %d free database pages, %d left", before - after, after)
+
+    if db.maintenance_due('vacuum', cp.getfloat('maintenance', 'vacuum-days')):
+        log.info("vacuuming database")
+        db.vacuum()
+
+    if db.maintenance_due('optimize', cp.getfloat('maintenance', 'optimize-days')):
+        log.debug("optimizing database")
+        db.optimize()
@@ -0,0 +1,166 @@
+import collections
+import contextlib
+import threading
+import json
+import time
+import os
+
+_prefix = 'reddit_image_download'
+_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_lock = threading.Lock()
+_timings = {}
+_counters = collections.Counter()
+
+
+class _Histogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(_buckets)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(_buckets):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def summary(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'max': self.max,
+                'buckets': dict(zip((str(b) for b in _buckets), self.buckets))}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def _display(key):
+    name, labels = key
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}={v}' for k, v in labels) + '}'
+
+
+@contextlib.contextmanager
+def stage(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        if key not in _timings:
+            _timings[key] = _Histogram()
+        _timings[key].observe(seconds)
+
+
+def count(name, n=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += n
+
+
+def take():
+    # everything recorded so far, in a picklable form, and start over; used to
+    # send the measurements from a render process back to the main process
+    with _lock:
+        taken = (dict(_timings), dict(_counters))
+        _timings.clear()
+        _counters.clear()
+        return taken
+
+
+def merge(taken):
+    timings, counters = taken
+    with _lock:
+        for key, histogram in timings.items():
+            if key not in _timings:
+                _timings[key] = _Histogram()
+            _timings[key].merge(histogram)
+        _counters.update(counters)
+
+
+def snapshot():
+    with _lock:
+        return {'stages': {_display(k): h.summary() for k, h in sorted(_timings.items())},
+                'counters': {_display(k): v for k, v in sorted(_counters.items())}}
+
+
+def reset():
+    take()
+
+
+def _label_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def _prometheus_text():
+    lines = []
+    with _lock:
+        timings = sorted(_timings.items())
+        counters = sorted(_counters.items())
+
+    metric = f'{_prefix}_stage_seconds'
+    lines.append(f'# HELP {metric} Time spent in each stage of the last run.')
+    lines.append(f'# TYPE {metric} histogram')
+    for (name, labels), h in timings:
+        labels = (('stage', name),) + labels
+        for bound, n in zip(_buckets, h.buckets):
+            lines.append(f'{metric}_bucket{_label_text(labels, [("le", bound)])} {n}')
+        lines.append(f'{metric}_bucket{_label_text(labels, [("le", "+Inf")])} {h.count}')
+        lines.append(f'{metric}_sum{_label_text(labels)} {h.sum}')
+        lines.append(f'{metric}_count{_label_text(labels)} {h.count}')
+
+    # per-run totals; they start from zero every run, so they are gauges
+    seen = set()
+    for (name, labels), value in counters:
+        metric = f"{_prefix}_last_run_{name.replace('-', '_')}"
+        if metric not in seen:
+            lines.append(f'# TYPE {metric} gauge')
+            seen.add(metric)
+        lines.append(f'{metric}{_label_text(labels)} {value}')
+
+    metric = f'{_prefix}_last_run_timestamp_seconds'
+    lines.append(f'# TYPE {metric} gauge')
+    lines.append(f'{metric} {time.time()}')
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomic(path, text):
+    path = os.path.expanduser(path)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def write_reports(cp, log):
+    json_path = cp['metrics']['json']
+    if json_path:
+        summary = snapshot()
+        summary['timestamp'] = time.time()
+        _write_atomic(json_path, json.dumps(summary, indent=2) + '\n')
+        log.info("wrote metrics to %s", json_path)
+
+    prometheus_path = cp['metrics']['prometheus']
+    if prometheus_path:
+        _write_atomic(prometheus_path, _prometheus_text())
+        log.info("wrote prometheus metrics to %s", prometheus_path)
@@ -0,0 +1,289 @@
+from code.download import download_image
+from code.edit import edit_image, render_fingerprint
+from code.encode import Encoder
+from code.filesys import try_remove_image
+from code.dedup import perceptual_hash, HashIndex
+from code.cache import OriginalCache
+from code.censor import Censor
+from code.retry import is_transient
+from code import metrics
+
+import os
+import logging
+import tempfile
+import contextlib
+import collections
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+_render_cp = None
+_render_log = None
+
+
+def _download(record, directory, cache, cp, log):
+    # rate limiting is per host, in the session
+    download = download_image(record, directory, log, cache)
+    if download is not None and cp.getboolean('dedup', 'perceptual'):
+        with metrics.stage('phash'):
+            download.phash = perceptual_hash(download.path)
+    return download
+
+
+def _init_render_worker(cp, log_name, log_level):
+    global _render_cp, _render_log
+    logging.basicConfig()
+    _render_cp = cp
+    _render_log = logging.getLogger(log_name)
+    _render_log.setLevel(log_level)
+    # a forked worker starts with a copy of the parent's measurements
+    metrics.reset()
+
+
+def _render(path, record, temporary):
+    # the timings of each step are sent back with the result, so they can be
+    # added to the main process' metrics
+    try:
+        return edit_image(path, record, _render_cp, _render_log), metrics.take()
+    finally:
+        if temporary:
+            os.remove(path)
+
+
+def _render_workers(cp):
+    workers = cp.getint('render', 'workers')
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def render_pool(cp, log):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=_render_workers(cp),
+                                                  initializer=_init_render_worker,
+                                                  initargs=(cp, log.name, log.getEffectiveLevel()))
+
+
+def download_images(db, cen, cp, log, renderer=None):
+    image_limit = cp.getint('limits', 'images')
+    download_workers = max(1, cp.getint('download', 'workers'))
+    render_workers = _render_workers(cp)
+    queue_size = max(1, cp.getint('render', 'queue'))
+    # the database is only read once; after that it only records outcomes
+    pending = collections.deque(db.get_pending_downloads())
+    n = db.get_image_count()
+    if not pending or n >= image_limit:
+        # no workers are started when there is nothing to do
+        log.info(f"reached {image_limit} images" if n >= image_limit else "out of images")
+        return 0
+    if cen is None:
+        cen = Censor(cp)
+    download_bytes = 0
+    cache = OriginalCache.from_config(cp, log)
+    fingerprint = render_fingerprint(cp)
+    encoder = Encoder.from_config(cp).name
+    resolve_ttl = cp.getfloat('resolver', 'ttl-days')
+    # the hashes of in-flight images are in here too, so copies within a run
+    # are caught; they are only stored once the image is rendered
+    hashes = HashIndex.from_database(db, cp)
+
+    # download stage -> bounded queue of downloaded images -> render stage
+    downloading = {}
+    ready = collections.deque()
+    rendering = {}
+
+    def exclude(record, reason):
+        metrics.count('excluded', reason=reason)
+        log.info(f"excluding {record['url']}")
+        db.exclude_url(record['url'], reason)
+
+    def defer(record, reason):
+        # transient failures are tried again on a later run, until there have
+        # been too many of them
+        failures = db.defer_url(record['url'], reason, cp.getint('retry', 'defer-minutes'))
+        if failures >= cp.getint('retry', 'max-deferrals'):
+            exclude(record, reason)
+        else:
+            metrics.count('deferred', reason=reason)
+            log.info(f"will try {record['url']} again later ({failures} failures)")
+
+    def broken(e):
+        # a render process died on one of the images in flight, and the pool
+        # has to be replaced, which is up to the caller; they are all tried
+        # again later, so one that keeps killing it is excluded in the end.
+        # Whatever was not being rendered yet is still pending
+        for record, _ in rendering.values():
+            log.error("error: %s, url=%s", e, record['url'])
+            defer(record, e.__class__.__name__)
+
+    # downloads are spooled to files here and removed once rendered; a
+    # long-running caller can pass in its own render pool to keep it warm
+    with tempfile.TemporaryDirectory(prefix='reddit_image_download.') as spool, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as downloader, \
+         (contextlib.nullcontext(renderer) if renderer is not None else render_pool(cp, log)) as renderer:
+        while True:
+            # a download only starts once it has a reserved place in the
+            # render queue, and never while there are fewer image slots left
+            # than images in progress, so the limit holds even if all succeed
+            while (pending
+                   and len(downloading) < download_workers
+                   and len(downloading) + len(ready) < queue_size
+                   and n + len(downloading) + len(ready) + len(rendering) < image_limit):
+                next_file = pending.popleft()
+                log.debug(f"fetching {next_file['url']}")
+                record = {k:next_file[k] for k in next_file.keys()}
+                record['resolved_url'] = db.get_resolved_url(record['url'], resolve_ttl)
+                cen.censor_record(record, log)
+                downloading[downloader.submit(_download, record, spool, cache, cp, log)] = record
+
+            while ready and len(rendering) < render_workers:
+                record, download = ready.popleft()
+                try:
+                    rendering[renderer.submit(_render, download.path, record, download.temporary)] = (record, download)
+                except BrokenProcessPool as e:
+                    broken(e)
+                    raise
+
+            if not downloading and not rendering:
+                break
+
+            done, _ = concurrent.futures.wait(list(downloading) + list(rendering),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in downloading:
+                    record = downloading.pop(future)
+                    try:
+                        download = future.result()
+                    except Exception as e:
+                        if getattr(e, 'resolved_url', None) is not None:
+                            db.record_resolved_url(record['url'], e.resolved_url)
+                        if is_transient(e):
+                            log.warning("error: %s, url=%s", e, record['url'])
+                            defer(record, e.__class__.__name__)
+                        else:
+                            log.exception("error: %s, url=%s", e, record['url'])
+                            exclude(record, e.__class__.__name__)
+                        continue
+
+                    if download is None:
+                        log.info(f"no response for {record['url']}")
+                        exclude(record, 'NoResponse')
+                        continue
+
+                    download_bytes += download.total_bytes
+                    metrics.count('bytes-downloaded', download.total_bytes)
+                    if download.resolved_url is not None:
+                        db.record_resolved_url(record['url'], download.resolved_url)
+
+                    # crossposts and rehosts are not rendered twice
+                    duplicate = hashes.find(download.sha256, download.phash)
+                    if duplicate is not None:
+                        log.info(f"{record['url']} is a duplicate of {duplicate['url']}")
+                        if download.temporary:
+                            os.remove(download.path)
+                        else:
+                            cache.unpin(download.path)
+                        exclude(record, 'duplicate')
+                        continue
+
+                    hashes.add(record['url'], record['postcode'], download.sha256, download.phash)
+                    ready.append((record, download))
+                else:
+                    record, download = rendering.pop(future)
+                    if not download.temporary:
+                        cache.unpin(download.path)
+                    try:
+                        filename, measurements = future.result()
+                    except BrokenProcessPool as e:
+                        rendering[future] = (record, download)
+                        broken(e)
+                        raise
+                    except Exception as e:
+                        log.exception("error: %s, url=%s", e, record['url'])
+                        hashes.remove(record['url'], download.sha256, download.phash)
+                        exclude(record, e.__class__.__name__)
+                        continue
+                    metrics.merge(measurements)
+
+                    n += 1
+                    metrics.count('images-written')
+                    log.debug("wrote %s (%d)", filename, n)
+                    db.track_image(record['url'], filename, fingerprint, encoder)
+                    db.record_hash(record['url'], download.sha256, download.phash)
+
+    if cache is not None:
+        log.info("download cache: %d hits, %d misses", cache.hits, cache.misses)
+    if n >= image_limit:
+        log.info(f"reached {image_limit} images")
+    elif not pending:
+        log.info("out of images")
+    return download_bytes
+
+
+def rerender_images(db, cen, cp, log):
+    download_workers = max(1, cp.getint('download', 'workers'))
+    fingerprint = render_fingerprint(cp)
+    encoder = Encoder.from_config(cp).name
+    stale = db.get_stale_images(fingerprint)
+    cache = OriginalCache.from_config(cp, log)
+    resolve_ttl = cp.getfloat('resolver', 'ttl-days')
+    log.info("%d images were rendered with different settings", len(stale))
+
+    downloading = {}
+    rendering = {}
+    rendered = 0
+
+    with tempfile.TemporaryDirectory(prefix='reddit_image_download.') as spool, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as downloader, \
+         render_pool(cp, log) as renderer:
+
+        # cached originals go straight to the render pool, the rest are
+        # downloaded again first
+        for item in stale:
+            record = {k:item[k] for k in item.keys()}
+            record['resolved_url'] = db.get_resolved_url(record['url'], resolve_ttl)
+            cen.censor_record(record, log)
+            entry = cache.lookup(record['url']) if cache is not None else None
+            if entry is not None:
+                download = cache.load(record['url'], entry)
+                rendering[renderer.submit(_render, download.path, record, download.temporary)] = (record, download)
+            else:
+                downloading[downloader.submit(_download, record, spool, cache, cp, log)] = record
+
+        while downloading or rendering:
+            done, _ = concurrent.futures.wait(list(downloading) + list(rendering),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in downloading:
+                    record = downloading.pop(future)
+                    try:
+                        download = future.result()
+                    except Exception as e:
+                        log.exception("could not fetch original: %s, url=%s", e, record['url'])
+                        if getattr(e, 'resolved_url', None) is not None:
+                            db.record_resolved_url(record['url'], e.resolved_url)
+                        continue
+                    if download is not None and download.resolved_url is not None:
+                        db.record_resolved_url(record['url'], download.resolved_url)
+                    if download is not None:
+                        rendering[renderer.submit(_render, download.path, record, download.temporary)] = (record, download)
+                else:
+                    record, download = rendering.pop(future)
+                    if not download.temporary:
+                        cache.unpin(download.path)
+                    try:
+                        filename, measurements = future.result()
+                    except Exception as e:
+                        # the old file is left alone
+                        log.exception("error: %s, url=%s", e, record['url'])
+                        continue
+                    metrics.merge(measurements)
+
+                    rendered += 1
+                    metrics.count('images-rerendered')
+                    log.debug("re-rendered %s", filename)
+                    db.set_fingerprint(record['url'], filename, fingerprint, encoder)
+                    # a different encoder can mean a different extension
+                    if filename != record['filename']:
+                        try_remove_image(record['filename'])
+                        log.debug("deleted file %s", record['filename'])
+
+    return rendered
@@ -0,0 +1,113 @@
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from code import metrics
+import threading
+import time
+
+_throttle_statuses = {429, 503}
+# without a Retry-After, a throttled host gets at least this long of a pause
+_min_backoff = 1.0
+_max_backoff = 600.0
+_max_penalty = 32.0
+_recovery = 0.9
+
+
+def parse_retry_after(value):
+    # delta-seconds or an HTTP date
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    # requests are spaced interval seconds apart, with up to burst of them
+    # allowed back to back after an idle period; each throttling response
+    # doubles the interval and each good response brings it back down
+    def __init__(self, interval, burst):
+        self._interval = interval
+        self._burst = max(1, burst)
+        self._penalty = 1.0
+        self._next = 0.0
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            interval = self._interval * self._penalty
+            start = max(now, self._blocked_until, self._next - (self._burst - 1) * interval)
+            self._next = max(self._next, start) + interval
+            return start - now
+
+    def acquire(self):
+        # the slot is reserved under the lock, the wait happens outside it
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self, retry_after):
+        with self._lock:
+            self._penalty = min(_max_penalty, self._penalty * 2)
+            if retry_after is None:
+                retry_after = max(_min_backoff, self._interval * self._penalty)
+            self._blocked_until = max(self._blocked_until,
+                                      time.monotonic() + min(retry_after, _max_backoff))
+
+    def succeeded(self):
+        if self._penalty > 1.0:
+            with self._lock:
+                self._penalty = max(1.0, self._penalty * _recovery)
+
+
+class HostLimiter:
+    def __init__(self, interval, burst, host_intervals):
+        self._interval = interval
+        self._burst = burst
+        self._host_intervals = {host.lower(): seconds for host, seconds in host_intervals.items()}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cp):
+        host_intervals = {host: cp.getfloat('host-rate-limits', host)
+                          for host in cp.options('host-rate-limits')}
+        return cls(cp.getfloat('rate-limit', 'seconds'), cp.getint('rate-limit', 'burst'), host_intervals)
+
+    def _key(self, host):
+        # a configured domain covers its subdomains and shares one bucket
+        # with them; anything else gets a bucket of its own
+        parts = host.lower().split('.')
+        for i in range(len(parts)):
+            suffix = '.'.join(parts[i:])
+            if suffix in self._host_intervals:
+                return suffix, self._host_intervals[suffix]
+        return host.lower(), self._interval
+
+    def bucket(self, url):
+        host = urlparse(url).hostname or ''
+        key, interval = self._key(host)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(interval, self._burst)
+            return key, self._buckets[key]
+
+    def acquire(self, url):
+        key, bucket = self.bucket(url)
+        wait = bucket.acquire()
+        if wait > 0:
+            metrics.observe('rate-limit-wait', wait)
+        return key, bucket
+
+    def record(self, key, bucket, response):
+        if response.status_code in _throttle_statuses:
+            metrics.count('throttled', host=key)
+            bucket.throttled(parse_retry_after(response.headers.get('Retry-After')))
+        else:
+            bucket.succeeded()
@@ -0,0 +1,20 @@
+def run_retention(db, cp, log):
+    # posts nobody has seen for a while go, with everything about them; so do
+    # excluded posts once their reason's retention has passed and they have
+    # been out of the listing for as long
+    batch_size = cp.getint('retention', 'batch')
+    purged = db.purge_unseen_posts(cp.getfloat('retention', 'posts-days'), batch_size)
+    log.debug("purged %d posts that were not seen", len(purged))
+
+    for reason in db.get_exclusion_reasons():
+        if reason is None:
+            continue
+        if cp.has_option('retention-by-reason', reason):
+            num_days = cp.getfloat('retention-by-reason', reason)
+        else:
+            num_days = cp.getfloat('retention', 'excluded-days')
+        expired = db.purge_excluded_posts(reason, num_days, batch_size)
+        if expired:
+            log.debug("purged %d posts excluded as %s", len(expired), reason)
+        purged.extend(expired)
+    return purged
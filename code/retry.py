@@ -0,0 +1,71 @@
+from code import metrics
+import requests
+import threading
+import random
+import time
+
+
+class HostUnavailable(Exception):
+    pass
+
+
+def is_transient(e):
+    # worth trying again later: the host is down, overloaded or throttling,
+    # or the connection broke; anything else will fail the same way again
+    if isinstance(e, (HostUnavailable, requests.ConnectionError, requests.Timeout,
+                      requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return False
+
+
+def backoff_delay(attempt, base, limit):
+    # "full jitter": anywhere up to the exponential delay, so workers that
+    # failed together don't all come back together
+    return random.uniform(0, min(limit, base * 2 ** attempt))
+
+
+class _Circuit:
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.trial = False
+
+
+class CircuitBreaker:
+    # after threshold transient failures in a row a host gets no requests for
+    # cooldown seconds; then one request is let through, and its outcome
+    # closes the circuit or opens it again
+    def __init__(self, threshold, cooldown):
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cp):
+        return cls(cp.getint('circuit-breaker', 'failures'), cp.getfloat('circuit-breaker', 'cooldown'))
+
+    def check(self, host):
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit.failures < self._threshold:
+                return
+            if circuit.trial or time.monotonic() < circuit.open_until:
+                raise HostUnavailable(f'{host} is failing, not sending requests to it for now')
+            circuit.trial = True
+
+    def failed(self, host):
+        with self._lock:
+            circuit = self._circuits.setdefault(host, _Circuit())
+            circuit.failures += 1
+            circuit.trial = False
+            if circuit.failures >= self._threshold:
+                if circuit.failures == self._threshold:
+                    metrics.count('circuit-opened', host=host)
+                circuit.open_until = time.monotonic() + self._cooldown
+
+    def succeeded(self, host):
+        with self._lock:
+            self._circuits.pop(host, None)
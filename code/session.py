@@ -0,0 +1,164 @@
+from code.ratelimit import HostLimiter
+from code.retry import CircuitBreaker, is_transient, backoff_delay
+from code import metrics
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+import tempfile
+import hashlib
+import time
+import os
+
+_session = None
+_timeout = None
+_max_bytes = None
+_max_page_bytes = None
+_limiter = None
+_breaker = None
+_attempts = 1
+_backoff = None
+_chunk_size = 64 * 1024
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+class Download:
+    def __init__(self, url, path, size):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.total_bytes = size
+        self.sha256 = None
+        self.phash = None
+        self.etag = None
+        self.last_modified = None
+        # set when a page had to be fetched to find the image url
+        self.resolved_url = None
+        # spool files are removed once rendered, cached originals are kept
+        self.temporary = True
+
+
+def configure(cp):
+    global _session, _timeout, _max_bytes, _max_page_bytes, _limiter, _breaker, _attempts, _backoff
+
+    # one pool per host, kept alive between requests; with pool_block the
+    # connections-per-host setting is a hard cap shared by all workers
+    adapter = HTTPAdapter(pool_connections=cp.getint('http', 'hosts'),
+                          pool_maxsize=cp.getint('http', 'connections-per-host'),
+                          pool_block=True)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if _session is not None:
+        _session.close()
+    _session = session
+    _timeout = (cp.getfloat('http', 'connect-timeout'), cp.getfloat('http', 'read-timeout'))
+    _max_bytes = cp.getint('download', 'max-bytes')
+    _max_page_bytes = cp.getint('download', 'max-page-bytes')
+    _limiter = HostLimiter.from_config(cp)
+    _breaker = CircuitBreaker.from_config(cp)
+    _attempts = max(1, cp.getint('retry', 'attempts'))
+    _backoff = (cp.getfloat('retry', 'backoff'), cp.getfloat('retry', 'max-backoff'))
+
+
+def close():
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
+
+
+def get(url, **kwargs):
+    if _session is None:
+        raise RuntimeError('HTTP session used before session.configure() was called')
+    kwargs.setdefault('timeout', _timeout)
+    # each host has its own limit, so only requests to the same host wait
+    # on each other
+    key, bucket = _limiter.acquire(url)
+    response = _session.get(url, **kwargs)
+    _limiter.record(key, bucket, response)
+    return response
+
+
+def _stream(url, max_bytes, out, headers=None):
+    size = 0
+    with get(url, stream=True, headers=headers) as response:
+        if response.status_code == 304:
+            return None, response.headers
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length is not None and length.isdigit() and int(length) > max_bytes:
+            raise DownloadTooLarge(f'{url} is {length} bytes, limit is {max_bytes}')
+        for chunk in response.iter_content(_chunk_size):
+            size += len(chunk)
+            if size > max_bytes:
+                raise DownloadTooLarge(f'{url} is over the limit of {max_bytes} bytes')
+            out(chunk)
+        return size, response.headers
+
+
+def _retrying(url, fetch):
+    # transient failures are tried again after a jittered, growing delay;
+    # the circuit breaker stops all of this for a host that keeps failing
+    host = urlparse(url).hostname
+    for attempt in range(_attempts):
+        _breaker.check(host)
+        try:
+            result = fetch()
+        except Exception as e:
+            if not is_transient(e):
+                # the host answered, so it is up
+                _breaker.succeeded(host)
+                raise
+            _breaker.failed(host)
+            if attempt + 1 == _attempts:
+                raise
+            metrics.count('retries', host=host)
+            time.sleep(backoff_delay(attempt, *_backoff))
+        else:
+            _breaker.succeeded(host)
+            return result
+
+
+def fetch_text(url):
+    def fetch():
+        chunks = []
+        size, _ = _stream(url, _max_page_bytes, chunks.append)
+        return b''.join(chunks).decode('utf-8', errors='replace'), size
+    return _retrying(url, fetch)
+
+
+def fetch_file(url, directory, etag=None, last_modified=None):
+    # returns None if etag/last_modified were given and still match
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+    return _retrying(url, lambda: _fetch_file(url, directory, headers))
+
+
+def _fetch_file(url, directory, headers):
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        def write(chunk):
+            digest.update(chunk)
+            f.write(chunk)
+        try:
+            size, response_headers = _stream(url, _max_bytes, write, headers)
+        except:
+            f.close()
+            os.remove(f.name)
+            raise
+    if size is None:
+        os.remove(f.name)
+        return None
+
+    download = Download(url, f.name, size)
+    download.sha256 = digest.hexdigest()
+    download.etag = response_headers.get('ETag')
+    download.last_modified = response_headers.get('Last-Modified')
+    return download
@@ -1,49 +1,140 @@
 import re
 import time
+import collections
 from urllib.parse import urlparse
 
+_page_size = 100
+
+
+class Post:
+    # just the fields we use, copied out of the listing json, instead of a
+    # praw Submission that can make an API request on attribute access
+    __slots__ = ('id', 'url', 'title', 'author', 'subreddit', 'over_18', 'selftext_html')
+
+    def __init__(self, data):
+        self.id = data['id']
+        self.url = data.get('url') or ''
+        self.title = data['title']
+        self.author = data.get('author') or '[deleted]'
+        self.subreddit = data['subreddit']
+        self.over_18 = bool(data.get('over_18'))
+        self.selftext_html = data.get('selftext_html')
+
+
 def get_submissions(r, fileLimit, cp):
-    mreddit = r.multireddit(cp['multireddit']['user'], cp['multireddit']['multi'])
-    submissions = mreddit.hot(limit=fileLimit)
-    return submissions
+    path = 'user/{}/m/{}/hot'.format(cp['multireddit']['user'], cp['multireddit']['multi'])
+    after = None
+    remaining = fileLimit
+    while remaining > 0:
+        params = {'limit': min(remaining, _page_size), 'raw_json': 1}
+        if after is not None:
+            params['after'] = after
+        listing = r.request('GET', path, params=params)['data']
+        for child in listing['children']:
+            if child['kind'] == 't3':
+                yield Post(child['data'])
+        remaining -= len(listing['children'])
+        after = listing.get('after')
+        if after is None or not listing['children']:
+            break
 
 _url_exclusions = {
     'cross-post': r"reddit\.com/r",
     'non-file': r"/$",
     'gif': r"\.gifv?$"
 }
-_domain_exclusions = r"[.^](gfycat|youtube)\.com$|^v\.redd\.it$|^$"
+# excluded along with all of their subdomains
+_domain_exclusions = {'gfycat.com', 'youtube.com', 'v.redd.it'}
+# numbered backreferences and conditionals, which stop working once the
+# pattern's groups are renumbered
+_group_reference = re.compile(r'\\[1-9]|\(\?\(')
 
 
-def filter_submissions(subs, cp, log):
-    domain_exclusion_regex = re.compile(_domain_exclusions)
-    url_exclusion_regexes = {k:re.compile(v) for k,v in _url_exclusions.items()}
+def _refers_to_groups(regex):
+    return bool(re.compile(regex).groupindex) or _group_reference.search(regex) is not None
 
-    for s in subs:
-        url = s.url
-        log.debug("submission %s: %s %s", s.id, url, s.title)
-        domain = urlparse(url).hostname
-        if domain is None or domain_exclusion_regex.search(domain):
-            log.debug("domain %s excluded; skipping", domain)
-            continue
-        
-        if s.over_18:
-            log.debug("over 18 content")
-            if not cp.getboolean('allow', 'over18'):
-                log.debug("over 18; skipping")
-                continue
-        
+
+class FilterRules:
+    def __init__(self, domains, url_exclusions):
+        self._domains = frozenset(d.lower() for d in domains)
+        # one pass over the url for all the rules; the named group that
+        # matched gives the reason.  Rules with groups of their own can't be
+        # merged like that, so then each rule is tried in turn
+        self._reasons = {}
+        self._url_regex = None
+        self._url_rules = None
+        if any(_refers_to_groups(regex) for regex in url_exclusions.values()):
+            self._url_rules = [(reason, re.compile(regex)) for reason, regex in url_exclusions.items()]
+        elif url_exclusions:
+            groups = []
+            for i, (reason, regex) in enumerate(url_exclusions.items()):
+                group = f'rule{i}'
+                self._reasons[group] = reason
+                groups.append(f'(?P<{group}>{regex})')
+            self._url_regex = re.compile('|'.join(groups))
+        self.counts = collections.Counter()
+
+    @classmethod
+    def from_config(cls, cp):
+        domains = set(_domain_exclusions)
+        domains.update(cp.get('filters', 'domains', raw=True).replace(',', ' ').split())
+        url_exclusions = dict(_url_exclusions)
+        for reason in cp.options('url-filters'):
+            url_exclusions[reason] = cp.get('url-filters', reason, raw=True)
+        return cls(domains, url_exclusions)
+
+    def _excluded_domain(self, domain):
+        parts = domain.lower().split('.')
+        for i in range(len(parts)):
+            suffix = '.'.join(parts[i:])
+            if suffix in self._domains:
+                return suffix
+        return None
+
+    def excluded_url(self, url):
+        if self._url_rules is not None:
+            for reason, regex in self._url_rules:
+                if regex.search(url):
+                    return reason
+            return None
+        if self._url_regex is None:
+            return None
+        m = self._url_regex.search(url)
+        return self._reasons[m.lastgroup] if m else None
+
+    def check(self, s, cp):
+        domain = urlparse(s.url).hostname
+        if domain is None:
+            return 'no-domain'
+        excluded_domain = self._excluded_domain(domain)
+        if excluded_domain is not None:
+            return f'domain {excluded_domain}'
+        if s.over_18 and not cp.getboolean('allow', 'over18'):
+            return 'over18'
         if s.selftext_html is not None:
-            log.debug("self post; skipping")
-            continue
-        
-        for reason,regex in url_exclusion_regexes.items():
-            if regex.search(url):
-                log.debug("url excluded: %s; skipping", reason)
-                continue;
-        
-        if url == '':
-            log.warning("blank URL; skipping");
+            return 'self-post'
+        reason = self.excluded_url(s.url)
+        if reason is not None:
+            return reason
+        if s.url == '':
+            return 'blank-url'
+        return None
+
+    def log_counts(self, log):
+        for reason, count in self.counts.most_common():
+            log.info("filtered out %d submissions: %s", count, reason)
+
+
+def filter_submissions(subs, cp, log, rules=None):
+    if rules is None:
+        rules = FilterRules.from_config(cp)
+
+    for s in subs:
+        log.debug("submission %s: %s %s", s.id, s.url, s.title)
+        reason = rules.check(s, cp)
+        if reason is not None:
+            log.debug("excluded: %s; skipping", reason)
+            rules.counts[reason] += 1
             continue
 
         log.debug("passed filters")
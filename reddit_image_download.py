@@ -3,38 +3,37 @@
 from code.config import getConfig, writeConfig
 from code.censor import Censor
 from code.auth import Auth
-from code.submissions import get_submissions, filter_submissions
-from code.filesys import try_remove_image
-from code.download import download_image
-from code.edit import edit_image
+from code.submissions import get_submissions, filter_submissions, FilterRules
+from code.filesys import reconcile_directory
+from code.pipeline import download_images, rerender_images, render_pool
 from code.database import Database
+from code.encode import Encoder
+from code.maintenance import run_maintenance
+from code.retention import run_retention
+from code import session
+from code import metrics
 
-import praw
+from concurrent.futures.process import BrokenProcessPool
 import os
-import io
 import sys
 import logging
-from time import sleep
-import concurrent.futures
+import time
 
 logging.basicConfig()
 log = logging.getLogger('reddit_image_download')
 
 
-def main(authfile):
-
-    log.info("reddit_image_download.py")
-
+def _read_config():
     cp = getConfig(log=log)
     log.setLevel(getattr(logging, cp['logging']['level'].upper()))
     log.info("log level set to %s", cp['logging']['level'])
-    writeConfig(cp, log=log)
+    # the output settings are otherwise only read in the render workers, so
+    # a mistake there is caught here, before anything is fetched
+    Encoder.from_config(cp)
+    return cp
 
-    auth = Auth()
-    auth.readFromFile(authfile)
-    r = auth.login()
-    log.info("connected to reddit")
 
+def _change_to_image_directory(cp):
     imagePath = os.path.expanduser(cp['paths']['images'])
     log.debug("using image path %s", imagePath)
     if not os.path.exists(imagePath):
@@ -43,87 +42,201 @@ def main(authfile):
     os.chdir(imagePath)
     log.info("changed to directory %s", imagePath)
 
-    db = Database(cp['paths']['database'])
-    veryold = db.delete_very_old_entries(cp.getint('limits','age')+30)
-    log.info(f'removed {len(veryold)} old database entries')
-    for item in veryold:
-        log.debug(f'{item}')
-    old = db.exclude_old_entries(cp.getint('limits','age'))
-    log.info(f'excluded {len(old)} images due to age')
-    for item in old:
-        log.debug(f'{item}')
-
-    files = os.listdir('.')
-
-    fileLimit = cp.getint('limits', 'posts')
-    submissions = get_submissions(r, fileLimit, cp)
-    
-    download_bytes = 0
-    valid_urls = []
-
-    for s in filter_submissions(submissions, cp, log):
-        username = "[deleted]" if s.author is None else s.author.name
-        db.register_post(s.url, s.title, username, s.subreddit.display_name, s.id)
-        valid_urls.append(s.url)
-    log.info("%d items in download list", len(valid_urls))
-
-    missing = db.exclude_unpopular_urls(valid_urls)
-    log.info(f'excluded {len(missing)} images due to falling out of top posts')
-    for item in missing:
-        log.debug('{postcode}: {title}'.format(**item))
-
-    untracked = db.get_untracked_files(files)
-    log.info(f'deleting {len(untracked)} images')
-    for filename in untracked:
-        try_remove_image(filename)
-        log.debug(f'deleted file {filename}')
 
-    cen = Censor(cp)
+def _login(authfile):
+    auth = Auth()
+    auth.readFromFile(authfile)
+    r = auth.login()
+    log.info("connected to reddit")
+    return r
+
+
+def main(authfile):
+
+    log.info("reddit_image_download.py")
 
-    download_bytes = 0
-
-    while True:
-        next_file = db.get_next_to_download()
-        if next_file is None:
-            log.info("out of images")
-            break
-
-        n = db.get_image_count()
-        if n >= cp.getint('limits','images'):
-            log.info(f"reached {cp['limits']['images']} images")
-            break
-
-        log.debug(f"fetching {next_file['url']}")
-        record = {k:next_file[k] for k in next_file.keys()}
-        cen.censor_record(record, log)
-
-        responses = download_image(record, log)
-        if not responses:
-            continue
-        download_bytes += sum(len(x.content) for x in responses)
-        response = responses[-1]
-
-        # edit data
-        try:
-            bio = io.BytesIO(response.content)
-            filename = edit_image(bio, record, cp, log)
-            log.debug("wrote %s (%d)", filename, n+1)
-            db.track_image(record['url'], filename)
-        except Exception as e:
-            log.exception("error: %s, url=%s", e, record['url'])
-            log.info(f"excluding {record['url']}")
-            db.exclude_url(record['url'], e.__class__.__name__)
-            bio.close()
-            
-        # rate limiting
-        sleep(cp.getfloat('rate-limit', 'seconds'))
-            
+    cp = _read_config()
+    writeConfig(cp, log=log)
+
+    r = _login(authfile)
+
+    run(cp, r)
+
+
+def _prune(db, cp):
+    with metrics.stage('prune'):
+        veryold = run_retention(db, cp, log)
+        log.info(f'removed {len(veryold)} old database entries')
+        for item in veryold:
+            log.debug(f'{item}')
+        old = db.exclude_old_entries(cp.getint('limits','age'))
+        log.info(f'excluded {len(old)} images due to age')
+        for item in old:
+            log.debug(f'{item}')
+    metrics.count('pruned', len(veryold))
+    metrics.count('excluded', len(old), reason='age')
+
+
+def _get_listing(r, cp):
+    with metrics.stage('listing'):
+        fileLimit = cp.getint('limits', 'posts')
+        submissions = list(get_submissions(r, fileLimit, cp))
+    metrics.count('listed', len(submissions))
+
+    with metrics.stage('filter'):
+        rules = FilterRules.from_config(cp)
+        listing = []
+        for s in filter_submissions(submissions, cp, log, rules):
+            listing.append((s.url, s.title, s.author, s.subreddit, s.id))
+        rules.log_counts(log)
+    for reason, count in rules.counts.items():
+        metrics.count('filtered', count, reason=reason)
+    return listing
+
+
+def _update_listing(db, listing):
+    with metrics.stage('register'):
+        registration = db.register_posts(listing)
+        log.info("%d items in download list (%d new)", len(listing), len(registration.new))
+    metrics.count('registered', len(registration.new), kind='new')
+    metrics.count('registered', len(registration.refreshed), kind='refreshed')
+
+    with metrics.stage('exclude'):
+        missing = db.exclude_unpopular_urls(registration)
+        log.info(f'excluded {len(missing)} images due to falling out of top posts')
+        for item in missing:
+            log.debug('{postcode}: {title}'.format(**item))
+    metrics.count('excluded', len(missing), reason='unpopular')
+
+
+def _cleanup(db):
+    with metrics.stage('cleanup'):
+        deleted = reconcile_directory(db, log)
+        log.info(f'deleted {len(deleted)} images')
+    metrics.count('files-deleted', len(deleted))
+
+
+def _finish(db, cp, download_bytes):
     log.info("%d files total", db.get_image_count())
     log.info("downloaded %d bytes total", download_bytes)
+
+    with metrics.stage('maintenance'):
+        run_maintenance(db, cp, log)
+    metrics.write_reports(cp, log)
+
+
+def run(cp, r):
+    _change_to_image_directory(cp)
+
+    db = Database(cp['paths']['database'])
+    _prune(db, cp)
+
+    _update_listing(db, _get_listing(r, cp))
+    _cleanup(db)
+
+    # the censor is built by download_images, if there is anything to download
+    session.configure(cp)
+    try:
+        with metrics.stage('pipeline'):
+            download_bytes = download_images(db, None, cp, log)
+    finally:
+        session.close()
+
+    _finish(db, cp, download_bytes)
+    return download_bytes
+
+
+def daemon(authfile):
+
+    log.info("reddit_image_download.py daemon")
+
+    cp = _read_config()
+    writeConfig(cp, log=log)
+    interval = cp.getfloat('daemon', 'interval-minutes') * 60
+
+    r = _login(authfile)
+    _change_to_image_directory(cp)
+
+    # everything that is expensive to set up is kept between cycles: the
+    # database connection, the HTTP session, the censor, and the render
+    # processes with their fonts
+    db = Database(cp['paths']['database'])
+    cen = Censor(cp)
+    session.configure(cp)
+    last_urls = None
+    renderer = render_pool(cp, log)
+    try:
+        while True:
+            started = time.monotonic()
+            metrics.reset()
+            try:
+                last_urls = _daemon_cycle(db, cen, cp, r, renderer, last_urls)
+            except BrokenProcessPool as e:
+                # a render process died, and the pool can't be used again
+                log.error("render pool broke: %s, starting a new one", e)
+                renderer.shutdown()
+                renderer = render_pool(cp, log)
+            except Exception as e:
+                log.exception("cycle failed: %s", e)
+            wait = interval - (time.monotonic() - started)
+            log.info("next cycle in %d seconds", max(0, wait))
+            time.sleep(max(0, wait))
+    finally:
+        renderer.shutdown()
+        session.close()
+
+
+def _daemon_cycle(db, cen, cp, r, renderer, last_urls):
+    _prune(db, cp)
+
+    # the exclusions only need updating when posts entered or left the top
+    # set, but the posts still in it are marked as seen either way, or the
+    # retention pass would take them for gone; the cleanup is cheap when
+    # nothing changed, since the directory is only scanned when its mtime did
+    listing = _get_listing(r, cp)
+    urls = frozenset(item[0] for item in listing)
+    if urls != last_urls:
+        _update_listing(db, listing)
+    else:
+        with metrics.stage('register'):
+            db.refresh_lastseen(listing)
+        log.info("listing unchanged")
+    _cleanup(db)
+
+    with metrics.stage('pipeline'):
+        download_bytes = download_images(db, cen, cp, log, renderer)
+    _finish(db, cp, download_bytes)
+    return urls
     
     
+def rerender():
+
+    log.info("reddit_image_download.py rerender")
+
+    cp = _read_config()
+    _change_to_image_directory(cp)
+
+    db = Database(cp['paths']['database'])
+    cen = Censor(cp)
+
+    session.configure(cp)
+    try:
+        with metrics.stage('rerender'):
+            rendered = rerender_images(db, cen, cp, log)
+    finally:
+        session.close()
+    log.info("re-rendered %d images", rendered)
+    metrics.write_reports(cp, log)
+
+
 if __name__ == "__main__":
     argv = sys.argv
+    if len(argv) == 2 and argv[1] == 'rerender':
+        rerender()
+        sys.exit()
+    if len(argv) in (2, 3) and argv[1] == 'daemon':
+        daemon(argv[2] if len(argv) == 3 else 'auth.txt')
+        sys.exit()
     if len(argv) < 2:
         argv.append('auth.txt')
     elif len(argv) > 2: